@@ -0,0 +1,64 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+#
+# Compares bandwidth saved against CPU spent compressing task-list payloads of
+# increasing size, for the encoders used by tasklist.compression. Run from the
+# `tasklist` directory:
+#
+#     python benchmarks/bench_compression.py
+import json
+import time
+import uuid
+
+from argparse import ArgumentParser
+
+from tasklist.compression import GzipCompressor, BrotliCompressor, brotli
+
+
+def make_payload(n_tasks):
+    user_uuids = [str(uuid.uuid4()) for _ in range(max(1, n_tasks // 50))]
+    return json.dumps({
+        str(uuid.uuid4()): {
+            'description': f'Task number {i}',
+            'completed': i % 3 == 0,
+            'user_uuid': user_uuids[i % len(user_uuids)],
+        }
+        for i in range(n_tasks)
+    }).encode('utf-8')
+
+
+def measure(make_compressor, payload, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        compressor = make_compressor()
+        size = len(compressor.compress(payload) + compressor.finish())
+    cpu_seconds = (time.process_time() - start) / repeat
+    return size, cpu_seconds
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark response compression.')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    encoders = {f'gzip-{level}': (lambda level=level: GzipCompressor(level)) for level in (1, 6, 9)}
+    if brotli is not None:
+        encoders.update({
+            f'br-{quality}': (lambda quality=quality: BrotliCompressor(quality))
+            for quality in (1, 4, 11)
+        })
+
+    print(f'{"tasks":>8} {"encoder":>8} {"raw KiB":>10} {"out KiB":>10} '
+          f'{"saved":>7} {"CPU ms":>9} {"MiB/s":>8}')
+    for n_tasks in args.tasks:
+        payload = make_payload(n_tasks)
+        for name, make_compressor in encoders.items():
+            size, cpu_seconds = measure(make_compressor, payload, args.repeat)
+            print(f'{n_tasks:>8} {name:>8} {len(payload) / 1024:>10.1f} '
+                  f'{size / 1024:>10.1f} {1 - size / len(payload):>7.1%} '
+                  f'{cpu_seconds * 1000:>9.2f} '
+                  f'{len(payload) / (1024 * 1024) / max(cpu_seconds, 1e-9):>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+#
+# Compares payload size and encode/decode time of the response formats in
+# tasklist.serialization (JSON, MessagePack and columnar MessagePack) on
+# task lists of increasing size. Run from the `tasklist` directory:
+#
+#     python benchmarks/bench_msgpack.py
+import json
+import sys
+import time
+import uuid
+
+from argparse import ArgumentParser
+
+from tasklist.models import Task
+from tasklist.serialization import JSON, MsgpackEncoder, from_msgpack, msgpack
+
+
+def make_tasks(n_tasks):
+    user_uuids = [uuid.uuid4() for _ in range(max(1, n_tasks // 50))]
+    return {
+        uuid.uuid4(): Task(
+            description=f'Task number {i}',
+            completed=i % 3 == 0,
+            user_uuid=user_uuids[i % len(user_uuids)],
+        )
+        for i in range(n_tasks)
+    }
+
+
+def decode_msgpack(payload):
+    return from_msgpack(msgpack.unpackb(payload, raw=False, strict_map_key=False))
+
+
+def measure(encoder, decode, tasks, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        payload = encoder.encode(tasks)
+    encode_seconds = (time.process_time() - start) / repeat
+    start = time.process_time()
+    for _ in range(repeat):
+        decode(payload)
+    decode_seconds = (time.process_time() - start) / repeat
+    return len(payload), encode_seconds, decode_seconds
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark response formats.')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if msgpack is None:
+        sys.exit('The msgpack package is not installed')
+
+    formats = {
+        'json': (JSON, json.loads),
+        'msgpack': (MsgpackEncoder(), decode_msgpack),
+        'columnar': (MsgpackEncoder(columnar=True), decode_msgpack),
+    }
+
+    print(f'{"tasks":>8} {"format":>9} {"KiB":>10} {"vs json":>8} '
+          f'{"encode ms":>10} {"decode ms":>10}')
+    for n_tasks in args.tasks:
+        tasks = make_tasks(n_tasks)
+        json_size = None
+        for name, (encoder, decode) in formats.items():
+            size, encode_seconds, decode_seconds = measure(encoder, decode, tasks, args.repeat)
+            json_size = json_size or size
+            print(f'{n_tasks:>8} {name:>9} {size / 1024:>10.1f} {size / json_size:>8.1%} '
+                  f'{encode_seconds * 1000:>10.2f} {decode_seconds * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+#
+# Measures request throughput of `python -m tasklist.serve` for an increasing
+# number of worker processes. Run from the `tasklist` directory against a
+# migrated database:
+#
+#     python benchmarks/bench_workers.py --workers 1 2 4 8
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not come up')
+
+
+def hammer(url, seconds):
+    count = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        count += 1
+    return count
+
+
+def run(workers, port, path, clients, seconds):
+    # All clients come from one address, and each worker keeps its own
+    # rate limit buckets: admission control would throttle the benchmark
+    # and skew the scaling, so it is turned off.
+    server = subprocess.Popen(
+        [
+            sys.executable, '-m', 'tasklist.serve',
+            '--workers', str(workers),
+            '--bind', f'127.0.0.1:{port}',
+        ],
+        env={**os.environ, 'TASKLIST_ADMISSION_ENABLED': 'false'},
+    )
+    url = f'http://127.0.0.1:{port}{path}'
+    try:
+        wait_until_up(url)
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            counts = list(executor.map(
+                lambda _: hammer(url, seconds),
+                range(clients),
+            ))
+    finally:
+        server.terminate()
+        server.wait()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark throughput per worker count.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--path', default='/task?completed=false')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f'{"workers":>8} {"req/s":>10} {"speedup":>8}')
+    for workers in args.workers:
+        throughput = run(workers, args.port, args.path, args.clients, args.seconds)
+        baseline = baseline or throughput
+        print(f'{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+-- tasks_archive (0006) references users, so it must go first.
+DROP TABLE IF EXISTS tasks_archive;
 DROP TABLE IF EXISTS users;
 CREATE TABLE users (
     uuid BINARY(16) PRIMARY KEY,
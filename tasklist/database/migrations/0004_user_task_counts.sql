@@ -0,0 +1,11 @@
+ALTER TABLE users
+    ADD task_count INT NOT NULL DEFAULT 0,
+    ADD open_task_count INT NOT NULL DEFAULT 0;
+UPDATE users SET
+    task_count = (
+        SELECT COUNT(*) FROM tasks WHERE tasks.user_uuid = users.uuid
+    ),
+    open_task_count = (
+        SELECT COUNT(*) FROM tasks
+        WHERE tasks.user_uuid = users.uuid AND NOT IFNULL(tasks.completed, FALSE)
+    );
@@ -0,0 +1,5 @@
+DROP TABLE IF EXISTS shard_directory;
+CREATE TABLE shard_directory (
+    user_uuid BINARY(16) PRIMARY KEY,
+    shard INT NOT NULL
+);
@@ -0,0 +1,14 @@
+ALTER TABLE tasks
+    ADD updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    ADD INDEX tasks_completed_updated_at (completed, updated_at);
+DROP TABLE IF EXISTS tasks_archive;
+CREATE TABLE tasks_archive (
+    uuid BINARY(16) PRIMARY KEY,
+    description NVARCHAR(1024),
+    completed BOOLEAN,
+    user_uuid BINARY(16),
+    updated_at TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX tasks_archive_user_uuid (user_uuid),
+    FOREIGN KEY (user_uuid) REFERENCES users(uuid) ON DELETE CASCADE
+);
@@ -0,0 +1,27 @@
+from argparse import ArgumentParser
+
+from tasklist.database import session_scope
+from tasklist.settings import load_settings
+
+
+def main():
+    parser = ArgumentParser(description='Move old completed tasks to the archive table.')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database secrets')
+    parser.add_argument('--older-than', type=float, help='Age in seconds; overrides archive_after_seconds')
+
+    args = parser.parse_args()
+    settings = load_settings(args.config, args.secrets)
+    older_than = settings.archive_after_seconds if args.older_than is None else args.older_than
+
+    with session_scope(pooled=False) as db:
+        archived = db.archive_completed_tasks(
+            older_than,
+            settings.archive_batch_size,
+            settings.archive_pause,
+        )
+    print(f'Archived {archived} tasks.')
+
+
+if __name__ == '__main__':
+    main()
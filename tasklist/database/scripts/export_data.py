@@ -0,0 +1,53 @@
+import sys
+import time
+
+from argparse import ArgumentParser
+
+from tasklist.bulk import TASK_COLUMNS, USER_COLUMNS, DataFormat, encode
+from tasklist.database import session_scope
+from tasklist.settings import load_settings
+
+TABLES = {
+    'tasks': ('iter_tasks', TASK_COLUMNS),
+    'users': ('iter_users', USER_COLUMNS),
+}
+
+
+def main():
+    parser = ArgumentParser(description='Export tasks or users to a file.')
+    parser.add_argument('table', choices=TABLES, help='What to export')
+    parser.add_argument('output', help='File to write')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database secrets')
+    parser.add_argument(
+        '--format',
+        type=DataFormat,
+        default=DataFormat.NDJSON,
+        choices=list(DataFormat),
+        help='Output format',
+    )
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Rows per chunk')
+
+    args = parser.parse_args()
+    load_settings(args.config, args.secrets)
+    iter_name, columns = TABLES[args.table]
+
+    rows = 0
+
+    def count_rows(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+
+    start = time.perf_counter()
+    # With sharding, the rows of every shard are exported.
+    with session_scope(pooled=False) as db, open(args.output, 'wb') as file:
+        for data in encode(count_rows(getattr(db, iter_name)(args.chunk_size)), columns, args.format):
+            file.write(data)
+    seconds = time.perf_counter() - start
+    print(f'Exported {rows} {args.table} in {seconds:.2f}s ({rows / seconds:.0f} rows/s).', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import sys
+import time
+
+from argparse import ArgumentParser
+
+import mysql.connector as cnt
+
+from tasklist.bulk import DataFormat, decode, decode_task, decode_user
+from tasklist.database import DBSession, session_scope
+from tasklist.settings import load_settings
+
+TABLES = {
+    'tasks': ('import_tasks', 'load_tasks_infile', decode_task),
+    'users': ('import_users', 'load_users_infile', decode_user),
+}
+
+
+def main():
+    parser = ArgumentParser(description='Import tasks or users from a file.')
+    parser.add_argument('table', choices=TABLES, help='What to import')
+    parser.add_argument('input', help='File to read')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database secrets')
+    parser.add_argument(
+        '--format',
+        type=DataFormat,
+        default=DataFormat.NDJSON,
+        choices=list(DataFormat),
+        help='Input format',
+    )
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per INSERT')
+    parser.add_argument(
+        '--load-data',
+        action='store_true',
+        help='Use LOAD DATA LOCAL INFILE (CSV exports only, needs local_infile on the server)',
+    )
+
+    args = parser.parse_args()
+    if args.load_data and args.format != DataFormat.CSV:
+        parser.error('--load-data only works with --format csv')
+    settings = load_settings(args.config, args.secrets)
+    # LOAD DATA writes to a single database and cannot route rows to shards.
+    if args.load_data and settings.shards:
+        parser.error('--load-data cannot be used with sharding')
+    import_name, load_name, decode_item = TABLES[args.table]
+
+    start = time.perf_counter()
+    if args.load_data:
+        connection = cnt.connect(**settings.credentials, allow_local_infile=True)
+        try:
+            rows = getattr(DBSession(connection), load_name)(args.input)
+        finally:
+            connection.close()
+    else:
+        # Batched inserts go through the sharded session when sharding is on.
+        with open(args.input, 'rb') as file, session_scope(pooled=False) as db:
+            rows = getattr(db, import_name)(
+                decode(file, args.format, decode_item, args.chunk_size),
+                args.chunk_size,
+            )
+    seconds = time.perf_counter() - start
+    print(f'Imported {rows} {args.table} in {seconds:.2f}s ({rows / seconds:.0f} rows/s).', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
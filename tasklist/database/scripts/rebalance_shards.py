@@ -0,0 +1,55 @@
+import uuid
+
+from argparse import ArgumentParser
+
+from tasklist.database import session_scope
+from tasklist.settings import load_settings
+
+
+def rebalance(db):
+    # Moves every user that is not on the shard the hash ring assigns it,
+    # e.g. after adding a shard to the config.
+    moved_users = moved_tasks = 0
+    for source in range(db.shard_count):
+        misplaced = [
+            uuid.UUID(user_uuid)
+            for chunk in db.shard(source).iter_users(1000)
+            for user_uuid, _ in chunk
+            if db.ring.shard_for(uuid.UUID(user_uuid)) != source
+        ]
+        for user_uuid in misplaced:
+            moved_tasks += db.move_user(user_uuid, source, db.ring.shard_for(user_uuid))
+            moved_users += 1
+    return moved_users, moved_tasks
+
+
+def main():
+    parser = ArgumentParser(description='Move users and their tasks between shards.')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database secrets')
+    parser.add_argument('--user', type=uuid.UUID, help='Move only this user')
+    parser.add_argument('--to', type=int, help='Target shard for --user (directory scheme)')
+
+    args = parser.parse_args()
+    settings = load_settings(args.config, args.secrets)
+    if not settings.shards:
+        parser.error('The config has no shards')
+
+    with session_scope(pooled=False) as db:
+        if args.user is None:
+            if settings.shard_scheme != 'hash':
+                parser.error('Rebalancing all users needs the hash scheme; use --user and --to')
+            moved_users, moved_tasks = rebalance(db)
+        else:
+            if args.to is None or not 0 <= args.to < db.shard_count:
+                parser.error('--user needs a valid --to shard')
+            if settings.shard_scheme != 'directory':
+                parser.error('Moving single users needs the directory scheme')
+            source = db.shard_for(args.user)
+            moved_tasks = db.move_user(args.user, source, args.to)
+            moved_users = int(source != args.to)
+    print(f'Moved {moved_users} users and {moved_tasks} tasks.')
+
+
+if __name__ == '__main__':
+    main()
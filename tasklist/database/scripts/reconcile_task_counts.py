@@ -0,0 +1,21 @@
+from argparse import ArgumentParser
+
+from tasklist.database import session_scope
+from tasklist.settings import load_settings
+
+
+def main():
+    parser = ArgumentParser(description='Repair drift in the per-user task counts.')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database secrets')
+
+    args = parser.parse_args()
+    load_settings(args.config, args.secrets)
+    # With sharding, every shard is reconciled.
+    with session_scope(pooled=False) as db:
+        repaired = db.reconcile_task_counts()
+    print(f'Repaired task counts of {repaired} users.')
+
+
+if __name__ == '__main__':
+    main()
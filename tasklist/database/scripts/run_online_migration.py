@@ -0,0 +1,41 @@
+from argparse import ArgumentParser
+
+from utils.utils import run_online_migration
+
+
+def main():
+    parser = ArgumentParser(description='Alter a table without blocking writes to it.')
+    parser.add_argument('table', help='Table to alter')
+    parser.add_argument('alter', help='ALTER TABLE clauses, e.g. "ADD priority INT NOT NULL DEFAULT 0"')
+    parser.add_argument('config', help='Service config file')
+    parser.add_argument('secrets', help='Service database admin secrets')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Rows copied per transaction')
+    parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between chunks')
+    parser.add_argument('--max-threads-running', type=int, help='Pause while the server runs more threads')
+    parser.add_argument('--replica', action='append', default=[], help='Replica host to watch; repeatable')
+    parser.add_argument('--max-lag', type=float, help='Pause while a replica lags more seconds')
+    parser.add_argument('--no-inplace', action='store_true', help='Copy instead of ALGORITHM=INPLACE')
+    parser.add_argument('--keep-old', action='store_true', help='Keep the old table as _<table>_old')
+    parser.add_argument('--abort', action='store_true', help='Drop an interrupted migration')
+
+    args = parser.parse_args()
+    if args.replica and args.max_lag is None:
+        parser.error('--replica needs --max-lag')
+    run_online_migration(
+        args.table,
+        args.alter,
+        args.config,
+        args.secrets,
+        replica_hosts=args.replica,
+        abort=args.abort,
+        chunk_size=args.chunk_size,
+        pause=args.pause,
+        max_threads_running=args.max_threads_running,
+        max_lag=args.max_lag,
+        allow_inplace=not args.no_inplace,
+        keep_old=args.keep_old,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+import abc
+import asyncio
+import hmac
+import math
+import re
+import threading
+import time
+
+from fastapi.responses import JSONResponse
+
+from .settings import get_settings
+
+
+class TokenBucketStore(abc.ABC):
+    # Interface for the rate limiter state. The default implementation keeps
+    # the buckets in process memory; a shared implementation (e.g. on Redis)
+    # makes the limits hold across workers and hosts. take() is awaited on
+    # the event loop, so it must not block: use an async client.
+    @abc.abstractmethod
+    async def take(self, key: str, cost: float, rate: float, burst: float) -> float:
+        # Takes `cost` tokens from the bucket `key`, which refills at `rate`
+        # tokens per second up to `burst`. Returns 0 when the tokens were
+        # taken, otherwise the number of seconds until they are available.
+        ...
+
+
+class InMemoryTokenBucketStore(TokenBucketStore):
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    async def take(self, key, cost, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sweep >= burst / rate:
+                self.sweep(now, rate, burst)
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+    def sweep(self, now, rate, burst):
+        # Called with the lock held. Drops the buckets that have refilled
+        # while idle: a missing bucket starts full, so nothing changes for
+        # their clients.
+        self.buckets = {
+            key: (tokens, last) for key, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * rate < burst
+        }
+        self.last_sweep = now
+
+
+UUID_SEGMENT = re.compile(r'/[0-9a-fA-F]{8}-?(?:[0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}(?=/|$)')
+
+
+def route_key(scope):
+    # UUIDs in the path are replaced by the route parameter, so settings
+    # can name routes like "GET /task/{uuid_}" and metric labels stay
+    # bounded.
+    path = UUID_SEGMENT.sub('/{uuid_}', scope['path'].rstrip('/') or '/')
+    return f"{scope['method']} {path}"
+
+
+def get_client_key(scope, settings):
+    # Only known API keys get a bucket of their own; anything else would let
+    # a client dodge its limit by sending a new key with each request.
+    for key, value in scope['headers']:
+        if key == b'x-api-key':
+            api_key = value.decode('latin-1')
+            if any(
+                    hmac.compare_digest(api_key, known)
+                    for known in [*settings.api_keys, *settings.admin_api_keys]
+            ):
+                return 'key:' + api_key
+    client = scope.get('client')
+    return 'ip:' + (client[0] if client else 'unknown')
+
+
+def throttled(retry_after, detail):
+    return JSONResponse(
+        status_code=429,
+        content={'detail': detail},
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, store: TokenBucketStore = None):
+        self.app = app
+        self.store = store or InMemoryTokenBucketStore()
+        self.semaphore = None
+        self.semaphore_size = None
+
+    def get_semaphore(self, size):
+        # Created lazily so it binds to the running event loop, and rebuilt
+        # when the setting changes.
+        if self.semaphore_size != size:
+            self.semaphore = asyncio.Semaphore(size)
+            self.semaphore_size = size
+        return self.semaphore
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        settings = get_settings()
+        if (
+                not settings.admission_enabled
+                or scope['path'] in settings.admission_exempt_paths
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        cost = min(
+            settings.rate_limit_costs.get(route_key(scope), 1.0),
+            settings.rate_limit_burst,
+        )
+        retry_after = await self.store.take(
+            get_client_key(scope, settings),
+            cost,
+            settings.rate_limit_rate,
+            settings.rate_limit_burst,
+        )
+        if retry_after > 0:
+            await throttled(retry_after, 'Rate limit exceeded')(scope, receive, send)
+            return
+
+        if not settings.max_concurrency:
+            await self.app(scope, receive, send)
+            return
+
+        semaphore = self.get_semaphore(settings.max_concurrency)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), settings.admission_queue_timeout)
+        except asyncio.TimeoutError:
+            await throttled(settings.admission_queue_timeout, 'Server busy')(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            semaphore.release()
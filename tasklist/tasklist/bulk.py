@@ -0,0 +1,286 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+import codecs
+import csv
+import enum
+import io
+import json
+import tempfile
+import time
+import uuid
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from mysql.connector.errors import IntegrityError
+
+from .database import session_scope
+from .models import ImportResult, Task, User
+from .settings import get_settings
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet support is optional
+    pyarrow = None
+
+from .serialization import from_msgpack, msgpack
+
+# Uploads larger than this are spooled to a temporary file on disk.
+IMPORT_SPOOL_SIZE = 16 * 1024 * 1024
+
+TASK_COLUMNS = ('uuid', 'description', 'completed', 'user_uuid')
+USER_COLUMNS = ('uuid', 'name')
+UUID_COLUMNS = ('uuid', 'user_uuid')
+
+
+class DataFormat(str, enum.Enum):
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+    PARQUET = 'parquet'
+    MSGPACK = 'msgpack'
+
+
+MEDIA_TYPES = {
+    DataFormat.CSV: 'text/csv',
+    DataFormat.NDJSON: 'application/x-ndjson',
+    DataFormat.PARQUET: 'application/vnd.apache.parquet',
+    DataFormat.MSGPACK: 'application/msgpack',
+}
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def check_format(data_format: DataFormat):
+    if data_format == DataFormat.PARQUET and pyarrow is None:
+        raise UnsupportedFormat('Parquet support requires the pyarrow package')
+    if data_format == DataFormat.MSGPACK and msgpack is None:
+        raise UnsupportedFormat('MessagePack support requires the msgpack package')
+
+
+# Encoding: each function takes an iterable of row chunks, as produced by
+# DBSession.iter_tasks/iter_users, and yields the encoded file piece by piece.
+
+def encode_csv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks:
+        writer.writerows(
+            [int(value) if isinstance(value, bool) else value for value in row]
+            for row in chunk
+        )
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode_ndjson(chunks, columns):
+    for chunk in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(columns, row))) + '\n'
+            for row in chunk
+        ).encode('utf-8')
+
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file collecting what the Parquet writer produces, so it can
+    # be handed out and dropped after each row group.
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_schema(columns):
+    types = {'completed': pyarrow.bool_()}
+    return pyarrow.schema([(column, types.get(column, pyarrow.string())) for column in columns])
+
+
+def encode_parquet(chunks, columns):
+    schema = parquet_schema(columns)
+    sink = ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            # One row group per chunk keeps the writer's memory bounded.
+            writer.write_table(pyarrow.Table.from_pylist(
+                [dict(zip(columns, row)) for row in chunk],
+                schema=schema,
+            ))
+            yield sink.take()
+    yield sink.take()
+
+
+def encode_msgpack(chunks, columns):
+    # A stream of maps, one per row, with UUIDs as 16-byte binaries.
+    packer = msgpack.Packer(use_bin_type=True)
+    for chunk in chunks:
+        yield b''.join(
+            packer.pack({
+                column: uuid.UUID(value).bytes if column in UUID_COLUMNS and value else value
+                for column, value in zip(columns, row)
+            })
+            for row in chunk
+        )
+
+
+ENCODERS = {
+    DataFormat.CSV: encode_csv,
+    DataFormat.NDJSON: encode_ndjson,
+    DataFormat.PARQUET: encode_parquet,
+    DataFormat.MSGPACK: encode_msgpack,
+}
+
+
+def encode(chunks, columns, data_format: DataFormat):
+    check_format(data_format)
+    return ENCODERS[data_format](chunks, columns)
+
+
+# Decoding: each function takes a binary file object and yields dicts keyed
+# by column name, which are then validated into rows by decode().
+
+def decode_csv(file, chunk_size):
+    reader = csv.DictReader(codecs.getreader('utf-8')(file))
+    for record in reader:
+        # DictReader puts extra values under None and fills missing ones
+        # with None.
+        if None in record or None in record.values():
+            raise ValueError(f'Line {reader.line_num} does not have as many fields as the header')
+        if 'completed' in record:
+            record['completed'] = record['completed'].lower() in ('1', 'true')
+        # An empty UUID means none; other empty fields are kept as they are.
+        yield {
+            key: value for key, value in record.items()
+            if value != '' or key not in UUID_COLUMNS
+        }
+
+
+def decode_ndjson(file, chunk_size):
+    for line in file:
+        if line.strip():
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Each NDJSON line must be an object')
+            yield record
+
+
+def decode_parquet(file, chunk_size):
+    for batch in pyarrow.parquet.ParquetFile(file).iter_batches(batch_size=chunk_size):
+        for record in batch.to_pylist():
+            yield {key: value for key, value in record.items() if value is not None}
+
+
+def decode_msgpack(file, chunk_size):
+    for record in msgpack.Unpacker(file, raw=False, strict_map_key=False):
+        if not isinstance(record, dict):
+            raise ValueError('Each MessagePack object must be a map')
+        yield {key: value for key, value in from_msgpack(record).items() if value is not None}
+
+
+DECODERS = {
+    DataFormat.CSV: decode_csv,
+    DataFormat.NDJSON: decode_ndjson,
+    DataFormat.PARQUET: decode_parquet,
+    DataFormat.MSGPACK: decode_msgpack,
+}
+
+
+def pop_uuid(record):
+    if 'uuid' not in record:
+        return uuid.uuid4()
+    value = record.pop('uuid')
+    if not isinstance(value, str):
+        raise ValueError('uuid must be a string')
+    return uuid.UUID(value)
+
+
+def decode_task(record):
+    uuid_ = pop_uuid(record)
+    return uuid_, Task(**record)
+
+
+def decode_user(record):
+    uuid_ = pop_uuid(record)
+    return uuid_, User(**record)
+
+
+def decode(file, data_format: DataFormat, decode_item, chunk_size):
+    # Yields (uuid, item) pairs; records without a UUID get a new one.
+    check_format(data_format)
+    for record in DECODERS[data_format](file, chunk_size):
+        yield decode_item(record)
+
+
+def check_format_or_400(data_format: DataFormat):
+    try:
+        check_format(data_format)
+    except UnsupportedFormat as exception:
+        raise HTTPException(status_code=400, detail=str(exception)) from exception
+
+
+def export_response(iter_name: str, columns, data_format: DataFormat, name: str):
+    # Streams the rows produced by DBSession.<iter_name> through a dedicated
+    # connection, which lives as long as the response body.
+    check_format_or_400(data_format)
+    chunk_size = get_settings().bulk_chunk_size
+
+    def generate():
+        with session_scope(pooled=False) as db:
+            yield from encode(getattr(db, iter_name)(chunk_size), columns, data_format)
+
+    return StreamingResponse(
+        generate(),
+        media_type=MEDIA_TYPES[data_format],
+        headers={'Content-Disposition': f'attachment; filename="{name}.{data_format.value}"'},
+    )
+
+
+async def import_request(request: Request, data_format: DataFormat, import_items, decode_item):
+    # Spools the upload, then inserts it in chunks; each chunk is committed
+    # on its own, so a failure leaves the preceding chunks in place.
+    check_format_or_400(data_format)
+    chunk_size = get_settings().bulk_chunk_size
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as file:
+        async for data in request.stream():
+            file.write(data)
+        file.seek(0)
+
+        start = time.perf_counter()
+        try:
+            rows = await run_in_threadpool(
+                import_items,
+                decode(file, data_format, decode_item, chunk_size),
+                chunk_size,
+            )
+        except ValueError as exception:
+            raise HTTPException(status_code=422, detail=str(exception)) from exception
+        except IntegrityError as exception:
+            raise HTTPException(status_code=409, detail=exception.msg) from exception
+        seconds = time.perf_counter() - start
+
+    return ImportResult(
+        rows=rows,
+        seconds=seconds,
+        rows_per_second=rows / seconds if seconds > 0 else 0.0,
+    )
@@ -0,0 +1,12 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+from fastapi import Response
+
+from .settings import get_settings
+
+
+def cache_control(name: str, default: str):
+    # Route dependency setting the Cache-Control header. The policy can be
+    # overridden per route name through the `cache_control` setting.
+    def set_cache_control(response: Response):
+        response.headers['Cache-Control'] = get_settings().cache_control.get(name, default)
+    return set_cache_control
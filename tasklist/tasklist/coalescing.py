@@ -0,0 +1,103 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+#
+# Single-flight layer for reads. Identical reads that arrive while one is
+# in flight wait for it and share its result instead of each taking a
+# connection and running the same query. Flights are per worker process.
+#
+# A committed write to a table detaches the flights reading it: reads
+# that already joined still get the in-flight result, which is no older
+# than the query itself, while later reads start a new query and see the
+# write. Writes committed by other workers cannot detach flights here, so
+# a read may return a result up to one query duration older than such a
+# write, as it could without coalescing.
+import threading
+
+from . import metrics
+from .deadline import Deadline, DeadlineExceeded
+
+
+class Flight:
+    def __init__(self, tables):
+        self.tables = tuple(tables)
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.keys_by_table = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: tuple, tables, function, deadline: Deadline = None):
+        # Runs function() unless an identical read (same key) is in flight,
+        # in which case its result is returned. key[0] names the read in
+        # the metrics.
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = Flight(tables)
+                    self.flights[key] = flight
+                    for table in flight.tables:
+                        self.keys_by_table.setdefault(table, set()).add(key)
+
+            if leader:
+                metrics.increment('read_flights_total', read=key[0])
+                return self.lead(key, flight, function)
+
+            metrics.increment('coalesced_reads_total', read=key[0])
+            timeout = None if deadline is None else max(0.0, deadline.remaining())
+            if not flight.done.wait(timeout):
+                raise DeadlineExceeded()
+            if flight.error is None:
+                return flight.result
+            # The leader ran out of its own time budget, which may be
+            # shorter than ours: try again.
+            if isinstance(flight.error, DeadlineExceeded) and deadline is not None:
+                deadline.check()
+                continue
+            raise flight.error
+
+    def lead(self, key, flight, function):
+        try:
+            flight.result = function()
+            return flight.result
+        except Exception as exception:
+            flight.error = exception
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    self.detach(key)
+            flight.done.set()
+
+    def detach(self, key):
+        # Called with the lock held.
+        flight = self.flights.pop(key)
+        for table in flight.tables:
+            keys = self.keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_table[table]
+
+    def invalidate(self, tables):
+        with self.lock:
+            for table in tables:
+                for key in list(self.keys_by_table.get(table, ())):
+                    self.detach(key)
+
+
+_single_flight = SingleFlight()
+
+
+def do(key: tuple, tables, function, deadline: Deadline = None):
+    return _single_flight.do(key, tables, function, deadline)
+
+
+def invalidate(tables):
+    _single_flight.invalidate(tables)
@@ -0,0 +1,189 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+import zlib
+
+from .settings import get_settings
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/msgpack',
+    'application/x-ndjson',
+    'text/',
+)
+
+# Bodies larger than this are compressed and sent in slices of this size, so
+# the client starts receiving data before the whole payload is compressed and
+# the compressed copy is never held in memory at once.
+SLICE_SIZE = 64 * 1024
+
+
+class GzipCompressor:
+    encoding = 'gzip'
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    encoding = 'br'
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def parse_accept_encoding(accept_encoding):
+    # Maps each coding to its quality; `*` stands for the codings not listed.
+    qualities = {}
+    for part in accept_encoding.lower().split(','):
+        coding, *parameters = [piece.strip() for piece in part.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def get_compressor(accept_encoding, settings):
+    # Picks the coding with the highest quality, brotli on ties; codings
+    # with q=0 are refused by the client.
+    qualities = parse_accept_encoding(accept_encoding)
+    candidates = []
+    if brotli is not None and settings.compression_brotli:
+        candidates.append(('br', lambda: BrotliCompressor(settings.compression_brotli_quality)))
+    candidates.append(('gzip', lambda: GzipCompressor(settings.compression_gzip_level)))
+
+    best, best_quality = None, 0.0
+    for coding, make_compressor in candidates:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = make_compressor, quality
+    return best() if best else None
+
+
+def get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        settings = get_settings()
+        accept_encoding = get_header(scope['headers'], b'accept-encoding') or ''
+        compressor = get_compressor(accept_encoding, settings)
+        if compressor is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = CompressionResponder(send, compressor, settings.compression_minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    def __init__(self, send, compressor, minimum_size):
+        self.downstream = send
+        self.compressor = compressor
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.state = 'start'  # start -> compress | passthrough
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body':
+            await self.downstream(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.state == 'start':
+            if not self.should_compress(body, more_body):
+                self.state = 'passthrough'
+                await self.downstream(self.start_message)
+                await self.downstream(message)
+                return
+            self.state = 'compress'
+            if not more_body and len(body) <= SLICE_SIZE:
+                data = self.compressor.compress(body) + self.compressor.finish()
+                await self.send_start(content_length=len(data))
+                await self.downstream({'type': 'http.response.body', 'body': data})
+                return
+            # Length unknown up front: the server falls back to chunked encoding.
+            await self.send_start(content_length=None)
+
+        if self.state == 'passthrough':
+            await self.downstream(message)
+            return
+
+        for start in range(0, len(body), SLICE_SIZE):
+            data = self.compressor.compress(body[start:start + SLICE_SIZE])
+            if data:
+                await self.downstream({
+                    'type': 'http.response.body',
+                    'body': data,
+                    'more_body': True,
+                })
+        await self.downstream({
+            'type': 'http.response.body',
+            'body': b'' if more_body else self.compressor.finish(),
+            'more_body': more_body,
+        })
+
+    def should_compress(self, body, more_body):
+        headers = self.start_message['headers']
+        if get_header(headers, b'content-encoding') is not None:
+            return False
+        content_type = get_header(headers, b'content-type') or ''
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        # Streamed bodies are always compressed; their size is unknown.
+        return more_body or len(body) >= self.minimum_size
+
+    async def send_start(self, content_length):
+        headers = [
+            (key, value) for key, value in self.start_message['headers']
+            if key.lower() not in (b'content-length', b'vary')
+        ]
+        vary = [
+            value for key, value in self.start_message['headers']
+            if key.lower() == b'vary'
+        ]
+        headers.append((b'content-encoding', self.compressor.encoding.encode('latin-1')))
+        headers.append((b'vary', b', '.join([*vary, b'Accept-Encoding'])))
+        if content_length is not None:
+            headers.append((b'content-length', str(content_length).encode('latin-1')))
+        await self.downstream({**self.start_message, 'headers': headers})
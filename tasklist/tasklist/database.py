@@ -1,37 +1,132 @@
 # pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
-import json
+import re
+import time
 import uuid
 
-from functools import lru_cache
+from contextlib import contextmanager
+from itertools import product
 
 import mysql.connector as conn
 
-from fastapi import Depends
+from mysql.connector import pooling
+from mysql.connector.errors import DatabaseError, PoolError
 
-from utils.utils import get_config_filename, get_app_secrets_filename
+from fastapi import Request, Response
 
-from .models import Task, User
+from . import coalescing, profiling
+from .deadline import Deadline, DeadlineExceeded
+from .models import Task, TaskFilter, User, UserWithCounts
+from .serialization import get_encoder
+from .settings import Settings, get_settings
+from .sharding import ShardedDBSession
+
+# MySQL error raised when a statement exceeds MAX_EXECUTION_TIME.
+ER_QUERY_TIMEOUT = 3024
+
+# Completed tasks are moved from the hot table to the archive, see
+# DBSession.archive_completed_tasks. Reads look in this order.
+TASK_TABLES = ('tasks', 'tasks_archive')
+
+# Statements that write to a table, capturing the table name.
+WRITE_STATEMENT = re.compile(
+    r'\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM'
+    r'|LOAD\s+DATA\s+LOCAL\s+INFILE\s+\S+\s+INTO\s+TABLE)\s+(\w+)',
+    re.IGNORECASE,
+)
+
+# Upper bound on the number of placeholders in a single `IN (...)` clause.
+BATCH_CHUNK_SIZE = 1000
+
+
+def chunked(items, size=BATCH_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def in_clause(size):
+    return '(' + ', '.join(['UUID_TO_BIN(%s)'] * size) + ')'
+
+
+def filter_conditions(task_filter: TaskFilter):
+    # SQL conditions for the user_uuid and completed parts of a filter; the
+    # UUID list is handled by the callers, which chunk it.
+    conditions = []
+    params = []
+    if task_filter.user_uuid is not None:
+        conditions.append('user_uuid = UUID_TO_BIN(%s)')
+        params.append(str(task_filter.user_uuid))
+    if task_filter.completed is not None:
+        conditions.append('completed = %s')
+        params.append(task_filter.completed)
+    return conditions, params
+
+
+class CountDeltas(dict):
+    # Accumulates (task_count, open_task_count) changes per user UUID.
+    def add(self, user_uuid, task_delta, open_task_delta):
+        user_uuid = str(user_uuid)
+        task_count, open_task_count = self.get(user_uuid, (0, 0))
+        self[user_uuid] = (task_count + task_delta, open_task_count + open_task_delta)
 
 
 class DBSession:
-    def __init__(self, connection: conn.MySQLConnection):
+    def __init__(self, connection: conn.MySQLConnection, deadline: Deadline = None):
         self.connection = connection
+        self.deadline = deadline
+        self.written_tables = set()
 
-    def read_tasks(self, completed: bool = None):
-        query = 'SELECT BIN_TO_UUID(uuid), description, completed, BIN_TO_UUID(user_uuid) FROM tasks'
+    def commit(self):
+        self.connection.commit()
+        # Reads of these tables started before the commit must not be
+        # joined by later ones.
+        if self.written_tables:
+            coalescing.invalidate(self.written_tables)
+            self.written_tables = set()
+
+    def _execute(self, cursor, query, params=()):
+        match = WRITE_STATEMENT.match(query)
+        if match:
+            self.written_tables.add(match.group(1))
+            # Deleting (or replacing) users cascades to their tasks.
+            if match.group(1) == 'users' and re.match(r'\s*(?:DELETE|REPLACE)\b', query, re.IGNORECASE):
+                self.written_tables.update(TASK_TABLES)
+        if self.deadline is not None:
+            self.deadline.check()
+            # Only top-level SELECTs honor the hint; writes are bounded by
+            # the deadline check between statements.
+            query = query.lstrip()
+            if query.startswith('SELECT'):
+                milliseconds = max(1, int(self.deadline.remaining() * 1000))
+                query = f'SELECT /*+ MAX_EXECUTION_TIME({milliseconds}) */' + query[len('SELECT'):]
+        started = time.perf_counter()
+        try:
+            cursor.execute(query, params)
+        except DatabaseError as exception:
+            if exception.errno == ER_QUERY_TIMEOUT:
+                raise DeadlineExceeded() from exception
+            raise
+        finally:
+            profiling.record_query(query, time.perf_counter() - started)
+
+    def read_tasks(self, completed: bool = None, include_archived: bool = False):
+        select = 'SELECT BIN_TO_UUID(uuid), description, completed, BIN_TO_UUID(user_uuid)'
+        where = ''
         if completed is not None:
-            query += ' WHERE completed = '
+            where = ' WHERE completed = '
             if completed:
-                query += 'True'
+                where += 'True'
             else:
-                query += 'False'
+                where += 'False'
+        query = f'{select} FROM tasks{where}'
+        if include_archived:
+            query += f' UNION ALL {select} FROM tasks_archive{where}'
 
         with self.connection.cursor() as cursor:
-            cursor.execute(query)
+            self._execute(cursor, query)
             db_results = cursor.fetchall()
 
         return {
-            uuid_: Task(
+            uuid.UUID(uuid_): Task(
                 description=field_description,
                 completed=bool(field_completed),
                 user_uuid=field_user_uuid,
@@ -43,101 +138,492 @@ class DBSession:
         uuid_ = uuid.uuid4()
 
         with self.connection.cursor() as cursor:
-            cursor.execute(
-                'INSERT INTO tasks VALUES (UUID_TO_BIN(%s), %s, %s, UUID_TO_BIN(%s))',
+            # The user row is locked for the counts before the INSERT takes
+            # a shared lock on it through the foreign key: the other way
+            # round, two creates for the same user deadlock.
+            self.__adjust_task_counts(cursor, item.user_uuid, 1, int(not item.completed))
+            self._execute(
+                cursor,
+                '''
+                INSERT INTO tasks (uuid, description, completed, user_uuid)
+                VALUES (UUID_TO_BIN(%s), %s, %s, UUID_TO_BIN(%s))
+                ''',
                 (str(uuid_), item.description, item.completed, str(item.user_uuid)),
             )
-        self.connection.commit()
+        self.commit()
 
         return uuid_
 
     def read_task(self, uuid_: uuid.UUID):
-        if not self.__task_exists(uuid_):
-            raise KeyError()
-
-        with self.connection.cursor() as cursor:
-            cursor.execute(
-                '''
-                SELECT description, completed, BIN_TO_UUID(user_uuid)
-                FROM tasks
-                WHERE uuid = UUID_TO_BIN(%s)
-                ''',
-                (str(uuid_), ),
-            )
-            result = cursor.fetchone()
-
-        return Task(description=result[0], completed=bool(result[1]), user_uuid=result[2])
+        # Archived tasks are served transparently, at the cost of a second
+        # query on a miss in the hot table.
+        for table in TASK_TABLES:
+            with self.connection.cursor() as cursor:
+                self._execute(
+                    cursor,
+                    f'''
+                    SELECT description, completed, BIN_TO_UUID(user_uuid)
+                    FROM {table}
+                    WHERE uuid = UUID_TO_BIN(%s)
+                    ''',
+                    (str(uuid_), ),
+                )
+                result = cursor.fetchone()
+            if result is not None:
+                return Task(description=result[0], completed=bool(result[1]), user_uuid=result[2])
+        raise KeyError()
+
+    def read_tasks_by_uuid(self, uuids):
+        missing = list(dict.fromkeys(uuids))
+        found = {}
+        for table in TASK_TABLES:
+            for chunk in chunked(missing):
+                with self.connection.cursor() as cursor:
+                    self._execute(
+                        cursor,
+                        f'''
+                        SELECT BIN_TO_UUID(uuid), description, completed, BIN_TO_UUID(user_uuid)
+                        FROM {table}
+                        WHERE uuid IN {in_clause(len(chunk))}
+                        ''',
+                        [str(uuid_) for uuid_ in chunk],
+                    )
+                    db_results = cursor.fetchall()
+                for uuid_, field_description, field_completed, field_user_uuid in db_results:
+                    found[uuid.UUID(uuid_)] = Task(
+                        description=field_description,
+                        completed=bool(field_completed),
+                        user_uuid=field_user_uuid,
+                    )
+            missing = [uuid_ for uuid_ in missing if uuid_ not in found]
+            if not missing:
+                break
+        return found, missing
 
     def replace_task(self, uuid_, item):
-        if not self.__task_exists(uuid_):
-            raise KeyError()
-
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            old_user_uuid, old_completed = self.__lock_task(cursor, uuid_)
+            # Both user rows are locked, in UUID order, before the UPDATE
+            # checks the foreign key, so concurrent reassignments between
+            # the same two users cannot deadlock.
+            counts = CountDeltas()
+            counts.add(old_user_uuid, -1, -int(not old_completed))
+            counts.add(item.user_uuid, 1, int(not item.completed))
+            self.__apply_count_deltas(cursor, counts)
+            self._execute(
+                cursor,
                 '''
                 UPDATE tasks SET description=%s, completed=%s, user_uuid=UUID_TO_BIN(%s)
                 WHERE uuid=UUID_TO_BIN(%s)
                 ''',
                 (item.description, item.completed, str(item.user_uuid), str(uuid_)),
             )
-        self.connection.commit()
+        self.commit()
 
     def remove_task(self, uuid_):
-        if not self.__task_exists(uuid_):
-            raise KeyError()
-
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            old_user_uuid, old_completed = self.__lock_task(cursor, uuid_)
+            self._execute(
+                cursor,
                 'DELETE FROM tasks WHERE uuid=UUID_TO_BIN(%s)',
                 (str(uuid_), ),
             )
-        self.connection.commit()
+            self.__adjust_task_counts(cursor, old_user_uuid, -1, -int(not old_completed))
+        self.commit()
 
     def remove_all_tasks(self):
+        removed = 0
         with self.connection.cursor() as cursor:
-            cursor.execute('DELETE FROM tasks')
-        self.connection.commit()
+            for table in TASK_TABLES:
+                self._execute(cursor, f'DELETE FROM {table}')
+                removed += cursor.rowcount
+            self._execute(cursor, 'UPDATE users SET task_count = 0, open_task_count = 0')
+        self.commit()
+        return removed
+
+    def update_tasks(self, task_filter: TaskFilter, update: dict, chunk_size: int = BATCH_CHUNK_SIZE):
+        # Sets the fields in `update` on every task matching the filter, one
+        # UPDATE per chunk of matching rows. Returns the number of tasks.
+        columns = {
+            'description': '%s',
+            'completed': '%s',
+            'user_uuid': 'UUID_TO_BIN(%s)',
+        }
+        assignments = ', '.join(f'{field}={columns[field]}' for field in update)
+        values = [
+            str(value) if isinstance(value, uuid.UUID) else value
+            for value in update.values()
+        ]
+
+        # Archived tasks that match are moved back to the hot table first; the
+        # archival job picks them up again later if they still qualify.
+        for cursor, rows in self.__lock_matching_tasks(task_filter, chunk_size, 'tasks_archive'):
+            self.__restore_archived_tasks(
+                cursor,
+                f'uuid IN ({", ".join(["%s"] * len(rows))})',
+                [row[0] for row in rows],
+            )
+            self.commit()
+
+        affected = 0
+        for cursor, rows in self.__lock_matching_tasks(task_filter, chunk_size):
+            self._execute(
+                cursor,
+                f'UPDATE tasks SET {assignments} WHERE uuid IN ({", ".join(["%s"] * len(rows))})',
+                values + [row[0] for row in rows],
+            )
+            counts = CountDeltas()
+            for _, user_uuid, completed in rows:
+                counts.add(user_uuid, -1, -int(not completed))
+                counts.add(
+                    str(update.get('user_uuid', user_uuid)),
+                    1,
+                    int(not update.get('completed', completed)),
+                )
+            self.__apply_count_deltas(cursor, counts)
+            self.commit()
+            affected += len(rows)
+        return affected
+
+    def remove_tasks(self, task_filter: TaskFilter, chunk_size: int = BATCH_CHUNK_SIZE):
+        affected = 0
+        for table in TASK_TABLES:
+            for cursor, rows in self.__lock_matching_tasks(task_filter, chunk_size, table):
+                self._execute(
+                    cursor,
+                    f'DELETE FROM {table} WHERE uuid IN ({", ".join(["%s"] * len(rows))})',
+                    [row[0] for row in rows],
+                )
+                counts = CountDeltas()
+                for _, user_uuid, completed in rows:
+                    counts.add(user_uuid, -1, -int(not completed))
+                self.__apply_count_deltas(cursor, counts)
+                self.commit()
+                affected += len(rows)
+        return affected
+
+    def select_tasks(self, task_filter: TaskFilter):
+        # Reads the tasks matching the filter, archived ones included,
+        # without locking them.
+        conditions, params = filter_conditions(task_filter)
+        if task_filter.uuids is None:
+            chunks = [(None, [])]
+        else:
+            chunks = [
+                (f'uuid IN {in_clause(len(chunk))}', [str(uuid_) for uuid_ in chunk])
+                for chunk in chunked(list(dict.fromkeys(task_filter.uuids)))
+            ]
+
+        tasks = {}
+        for (chunk_condition, chunk_params), table in product(chunks, TASK_TABLES):
+            where = ' AND '.join(([chunk_condition] if chunk_condition else []) + conditions)
+            with self.connection.cursor() as cursor:
+                self._execute(
+                    cursor,
+                    f'SELECT BIN_TO_UUID(uuid), description, completed, BIN_TO_UUID(user_uuid) FROM {table}'
+                    + (f' WHERE {where}' if where else ''),
+                    chunk_params + params,
+                )
+                db_results = cursor.fetchall()
+            for uuid_, field_description, field_completed, field_user_uuid in db_results:
+                tasks[uuid.UUID(uuid_)] = Task(
+                    description=field_description,
+                    completed=bool(field_completed),
+                    user_uuid=field_user_uuid,
+                )
+        return tasks
+
+    def __lock_matching_tasks(self, task_filter: TaskFilter, chunk_size: int, table: str = 'tasks'):
+        # Yields chunks of (binary uuid, user uuid, completed) for the tasks
+        # matching the filter, each locked until the caller commits. Without
+        # an explicit UUID list, the table is walked in primary key order.
+        conditions, params = filter_conditions(task_filter)
+
+        def select_chunk(cursor, chunk_condition, chunk_params):
+            where = ' AND '.join([chunk_condition] + conditions)
+            self._execute(
+                cursor,
+                f'''
+                SELECT uuid, BIN_TO_UUID(user_uuid), completed
+                FROM {table}
+                WHERE {where}
+                ORDER BY uuid
+                LIMIT {int(chunk_size)}
+                FOR UPDATE
+                ''',
+                chunk_params + params,
+            )
+            return [
+                (uuid_, user_uuid, bool(completed))
+                for uuid_, user_uuid, completed in cursor.fetchall()
+            ]
 
-    def __task_exists(self, uuid_: uuid.UUID):
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            if task_filter.uuids is not None:
+                uuids = list(dict.fromkeys(task_filter.uuids))
+                for chunk in chunked(uuids, chunk_size):
+                    rows = select_chunk(
+                        cursor,
+                        f'uuid IN {in_clause(len(chunk))}',
+                        [str(uuid_) for uuid_ in chunk],
+                    )
+                    if rows:
+                        yield cursor, rows
+                return
+
+            last_uuid = b''
+            while True:
+                rows = select_chunk(cursor, 'uuid > %s', [last_uuid])
+                if not rows:
+                    return
+                last_uuid = rows[-1][0]
+                yield cursor, rows
+
+    def __apply_count_deltas(self, cursor, counts):
+        # Always in UUID order, so transactions lock user rows in the same
+        # order.
+        for user_uuid, (task_delta, open_task_delta) in sorted(counts.items()):
+            if task_delta or open_task_delta:
+                self.__adjust_task_counts(cursor, user_uuid, task_delta, open_task_delta)
+
+    def iter_tasks(self, chunk_size: int = BATCH_CHUNK_SIZE):
+        # Streams all tasks, archived ones included, in chunks through an
+        # unbuffered (server-side) cursor, so memory use does not grow with
+        # the table. A stream abandoned halfway leaves unread rows on the
+        # connection, so use a connection that is closed afterwards, not a
+        # pooled one.
+        for table in TASK_TABLES:
+            cursor = self.connection.cursor(buffered=False)
+            self._execute(
+                cursor,
+                f'SELECT BIN_TO_UUID(uuid), description, completed, BIN_TO_UUID(user_uuid) FROM {table}',
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [
+                    (uuid_, description, bool(completed), user_uuid)
+                    for uuid_, description, completed, user_uuid in rows
+                ]
+            cursor.close()
+
+    def import_tasks(self, items, chunk_size: int = BATCH_CHUNK_SIZE):
+        # Inserts (uuid, Task) pairs with one multi-row INSERT and one count
+        # update per user for each chunk. Returns the number of tasks.
+        total = 0
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                total += self.__insert_tasks(chunk)
+                chunk = []
+        if chunk:
+            total += self.__insert_tasks(chunk)
+        return total
+
+    def __insert_tasks(self, chunk):
+        counts = CountDeltas()
+        params = []
+        for uuid_, item in chunk:
+            params.extend((str(uuid_), item.description, item.completed, str(item.user_uuid)))
+            counts.add(str(item.user_uuid), 1, int(not item.completed))
+
+        with self.connection.cursor() as cursor:
+            # Counts first, like create_task, so the user rows are locked
+            # before the INSERT checks the foreign keys.
+            self.__apply_count_deltas(cursor, counts)
+            self._execute(
+                cursor,
+                'INSERT INTO tasks (uuid, description, completed, user_uuid) VALUES '
+                + ', '.join(['(UUID_TO_BIN(%s), %s, %s, UUID_TO_BIN(%s))'] * len(chunk)),
+                params,
+            )
+        self.commit()
+        return len(chunk)
+
+    def load_tasks_infile(self, file_name: str):
+        # Bulk-loads a CSV export with LOAD DATA LOCAL INFILE. Requires a
+        # connection opened with allow_local_infile=True and local_infile
+        # enabled on the server. Returns the number of tasks loaded.
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
                 '''
-                SELECT EXISTS(
-                    SELECT 1 FROM tasks WHERE uuid=UUID_TO_BIN(%s)
+                LOAD DATA LOCAL INFILE %s INTO TABLE tasks
+                CHARACTER SET utf8mb4
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+                LINES TERMINATED BY '\\r\\n'
+                IGNORE 1 LINES
+                (@uuid, @description, @completed, @user_uuid)
+                SET
+                    uuid = UUID_TO_BIN(@uuid),
+                    description = @description,
+                    completed = @completed,
+                    user_uuid = UUID_TO_BIN(@user_uuid)
+                ''',
+                (file_name, ),
+            )
+            loaded = cursor.rowcount
+        self.commit()
+        self.reconcile_task_counts()
+        return loaded
+
+    def archive_completed_tasks(self, older_than: float, batch_size: int, pause: float = 0.0):
+        # Moves completed tasks not updated for `older_than` seconds to
+        # tasks_archive, one small transaction per batch so the hot table
+        # is never locked for long. Counts are unaffected: they include
+        # archived tasks. Returns the number of tasks archived. The batch
+        # is read in tasks_completed_updated_at order, so only its rows are
+        # scanned and locked.
+        archived = 0
+        while True:
+            with self.connection.cursor() as cursor:
+                self._execute(
+                    cursor,
+                    f'''
+                    SELECT uuid
+                    FROM tasks
+                    WHERE completed = TRUE AND updated_at <= NOW() - INTERVAL %s SECOND
+                    ORDER BY completed, updated_at
+                    LIMIT {int(batch_size)}
+                    FOR UPDATE
+                    ''',
+                    (older_than, ),
                 )
+                uuids = [row[0] for row in cursor.fetchall()]
+                if not uuids:
+                    self.commit()
+                    return archived
+                where = f'uuid IN ({", ".join(["%s"] * len(uuids))})'
+                self._execute(
+                    cursor,
+                    f'''
+                    INSERT INTO tasks_archive (uuid, description, completed, user_uuid, updated_at)
+                    SELECT uuid, description, completed, user_uuid, updated_at
+                    FROM tasks
+                    WHERE {where}
+                    ''',
+                    uuids,
+                )
+                self._execute(cursor, f'DELETE FROM tasks WHERE {where}', uuids)
+            self.commit()
+            archived += len(uuids)
+            if pause:
+                time.sleep(pause)
+
+    def __restore_archived_tasks(self, cursor, where, params):
+        self._execute(
+            cursor,
+            f'''
+            INSERT INTO tasks (uuid, description, completed, user_uuid)
+            SELECT uuid, description, completed, user_uuid
+            FROM tasks_archive
+            WHERE {where}
+            ''',
+            params,
+        )
+        restored = cursor.rowcount
+        self._execute(cursor, f'DELETE FROM tasks_archive WHERE {where}', params)
+        return restored
+
+    def reconcile_task_counts(self):
+        # Recomputes the materialized counts from `tasks` and
+        # `tasks_archive`, repairing any drift. Returns the number of users
+        # whose counts were wrong.
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
+                '''
+                UPDATE users
+                LEFT JOIN (
+                    SELECT
+                        user_uuid,
+                        COUNT(*) AS task_count,
+                        SUM(NOT IFNULL(completed, FALSE)) AS open_task_count
+                    FROM (
+                        SELECT user_uuid, completed FROM tasks
+                        UNION ALL
+                        SELECT user_uuid, completed FROM tasks_archive
+                    ) AS all_tasks
+                    GROUP BY user_uuid
+                ) AS counts ON counts.user_uuid = users.uuid
+                SET
+                    users.task_count = IFNULL(counts.task_count, 0),
+                    users.open_task_count = IFNULL(counts.open_task_count, 0)
                 ''',
-                (str(uuid_), ),
             )
-            results = cursor.fetchone()
-            found = bool(results[0])
-
-        return found
+            repaired = cursor.rowcount
+        self.commit()
+        return repaired
+
+    def __lock_task(self, cursor, uuid_: uuid.UUID, restore: bool = True):
+        # Reads the fields the user counts depend on, locking the row until
+        # the end of the transaction. An archived task is first moved back
+        # to the hot table, since it is about to be written.
+        self._execute(
+            cursor,
+            '''
+            SELECT BIN_TO_UUID(user_uuid), completed
+            FROM tasks
+            WHERE uuid=UUID_TO_BIN(%s)
+            FOR UPDATE
+            ''',
+            (str(uuid_), ),
+        )
+        result = cursor.fetchone()
+        if result is None:
+            if restore and self.__restore_archived_tasks(cursor, 'uuid=UUID_TO_BIN(%s)', (str(uuid_), )):
+                return self.__lock_task(cursor, uuid_, restore=False)
+            raise KeyError()
+        return result[0], bool(result[1])
+
+    def __adjust_task_counts(self, cursor, user_uuid, task_delta, open_task_delta):
+        self._execute(
+            cursor,
+            '''
+            UPDATE users
+            SET task_count = task_count + %s, open_task_count = open_task_count + %s
+            WHERE uuid=UUID_TO_BIN(%s)
+            ''',
+            (task_delta, open_task_delta, str(user_uuid)),
+        )
 
 #user functions
 
-    def read_users(self):
-        query = 'SELECT BIN_TO_UUID(uuid), name FROM users'
-        
+    def read_users(self, include_counts: bool = False):
+        query = 'SELECT BIN_TO_UUID(uuid), name, task_count, open_task_count FROM users'
+
         with self.connection.cursor() as cursor:
-            cursor.execute(query)
+            self._execute(cursor, query)
             db_results = cursor.fetchall()
 
+        if include_counts:
+            return {
+                uuid.UUID(uuid_): UserWithCounts(
+                    name=field_name,
+                    task_count=field_task_count,
+                    open_task_count=field_open_task_count,
+                )
+                for uuid_, field_name, field_task_count, field_open_task_count in db_results
+            }
         return {
-            uuid_: User(
+            uuid.UUID(uuid_): User(
                 name=field_name,
             )
-            for uuid_, field_name in db_results
+            for uuid_, field_name, _, _ in db_results
         }
 
     def create_user(self, item: User):
         uuid_ = uuid.uuid4()
 
         with self.connection.cursor() as cursor:
-            cursor.execute(
-                'INSERT INTO users VALUES (UUID_TO_BIN(%s), %s)',
+            self._execute(
+                cursor,
+                'INSERT INTO users (uuid, name) VALUES (UUID_TO_BIN(%s), %s)',
                 (str(uuid_), item.name),
             )
-        self.connection.commit()
+        self.commit()
 
         return uuid_
 
@@ -146,7 +632,8 @@ class DBSession:
             raise KeyError()
 
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            self._execute(
+                cursor,
                 '''
                 SELECT name
                 FROM users
@@ -158,39 +645,118 @@ class DBSession:
 
         return User(name=result[0])
 
+    def read_users_by_uuid(self, uuids):
+        uuids = list(dict.fromkeys(uuids))
+        found = {}
+        for chunk in chunked(uuids):
+            with self.connection.cursor() as cursor:
+                self._execute(
+                    cursor,
+                    f'''
+                    SELECT BIN_TO_UUID(uuid), name
+                    FROM users
+                    WHERE uuid IN {in_clause(len(chunk))}
+                    ''',
+                    [str(uuid_) for uuid_ in chunk],
+                )
+                db_results = cursor.fetchall()
+            for uuid_, field_name in db_results:
+                found[uuid.UUID(uuid_)] = User(name=field_name)
+        missing = [uuid_ for uuid_ in uuids if uuid_ not in found]
+        return found, missing
+
+    def iter_users(self, chunk_size: int = BATCH_CHUNK_SIZE):
+        # Same caveats as iter_tasks.
+        cursor = self.connection.cursor(buffered=False)
+        self._execute(cursor, 'SELECT BIN_TO_UUID(uuid), name FROM users')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+    def import_users(self, items, chunk_size: int = BATCH_CHUNK_SIZE):
+        total = 0
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                total += self.__insert_users(chunk)
+                chunk = []
+        if chunk:
+            total += self.__insert_users(chunk)
+        return total
+
+    def __insert_users(self, chunk):
+        params = []
+        for uuid_, item in chunk:
+            params.extend((str(uuid_), item.name))
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
+                'INSERT INTO users (uuid, name) VALUES '
+                + ', '.join(['(UUID_TO_BIN(%s), %s)'] * len(chunk)),
+                params,
+            )
+        self.commit()
+        return len(chunk)
+
+    def load_users_infile(self, file_name: str):
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
+                '''
+                LOAD DATA LOCAL INFILE %s INTO TABLE users
+                CHARACTER SET utf8mb4
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+                LINES TERMINATED BY '\\r\\n'
+                IGNORE 1 LINES
+                (@uuid, @name)
+                SET uuid = UUID_TO_BIN(@uuid), name = @name
+                ''',
+                (file_name, ),
+            )
+            loaded = cursor.rowcount
+        self.commit()
+        return loaded
+
     def replace_user(self, uuid_, item):
         if not self.__user_exists(uuid_):
             raise KeyError()
 
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            self._execute(
+                cursor,
                 '''
                 UPDATE users SET name=%s
                 WHERE uuid=UUID_TO_BIN(%s)
                 ''',
                 (item.name, str(uuid_)),
             )
-        self.connection.commit()
+        self.commit()
 
     def remove_user(self, uuid_):
         if not self.__user_exists(uuid_):
             raise KeyError()
 
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            self._execute(
+                cursor,
                 'DELETE FROM users WHERE uuid=UUID_TO_BIN(%s)',
                 (str(uuid_), ),
             )
-        self.connection.commit()
+        self.commit()
 
     def remove_all_users(self):
         with self.connection.cursor() as cursor:
-            cursor.execute('DELETE FROM users')
-        self.connection.commit()
+            self._execute(cursor, 'DELETE FROM users')
+        self.commit()
 
     def __user_exists(self, uuid_: uuid.UUID):
         with self.connection.cursor() as cursor:
-            cursor.execute(
+            self._execute(
+                cursor,
                 '''
                 SELECT EXISTS(
                     SELECT 1 FROM users WHERE uuid=UUID_TO_BIN(%s)
@@ -203,28 +769,175 @@ class DBSession:
 
         return found
 
+#shard directory functions
+
+    def read_shards(self, user_uuids):
+        # Maps the given user UUIDs to their shard, for the users found in
+        # the directory.
+        user_uuids = list(dict.fromkeys(user_uuids))
+        shards = {}
+        for chunk in chunked(user_uuids):
+            with self.connection.cursor() as cursor:
+                self._execute(
+                    cursor,
+                    f'''
+                    SELECT BIN_TO_UUID(user_uuid), shard
+                    FROM shard_directory
+                    WHERE user_uuid IN {in_clause(len(chunk))}
+                    ''',
+                    [str(uuid_) for uuid_ in chunk],
+                )
+                db_results = cursor.fetchall()
+            for user_uuid, shard in db_results:
+                shards[uuid.UUID(user_uuid)] = shard
+        return shards
 
+    def assign_shard(self, user_uuid: uuid.UUID, shard: int):
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
+                'REPLACE INTO shard_directory (user_uuid, shard) VALUES (UUID_TO_BIN(%s), %s)',
+                (str(user_uuid), shard),
+            )
+        self.commit()
 
-@lru_cache
-def get_credentials(
-        config_file_name: str = Depends(get_config_filename),
-        secrets_file_name: str = Depends(get_app_secrets_filename),
-):
-    with open(config_file_name, 'r') as file:
-        config = json.load(file)
-    with open(secrets_file_name, 'r') as file:
-        secrets = json.load(file)
-    return {
-        'user': secrets['user'],
-        'password': secrets['password'],
-        'host': config['db_host'],
-        'database': config['database'],
-    }
-
-
-def get_db(credentials: dict = Depends(get_credentials)):
+    def remove_shard_assignment(self, user_uuid: uuid.UUID):
+        with self.connection.cursor() as cursor:
+            self._execute(
+                cursor,
+                'DELETE FROM shard_directory WHERE user_uuid=UUID_TO_BIN(%s)',
+                (str(user_uuid), ),
+            )
+        self.commit()
+
+
+# Pools are per process: a pool inherited through fork() shares sockets with
+# the parent, so workers must call reset_pools() right after forking.
+_pools = {}
+
+
+def get_pool(credentials: dict, pool_size: int):
+    key = (tuple(sorted(credentials.items())), pool_size)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = pooling.MySQLConnectionPool(pool_size=pool_size, **credentials)
+        _pools[key] = pool
+    return pool
+
+
+def reset_pools():
+    _pools.clear()
+
+
+def open_connection(credentials: dict, pool_size: int, pooled: bool = True):
+    # Long-lived work, such as streaming exports, should not hold one of
+    # the few pooled connections.
+    if pooled:
+        try:
+            return get_pool(credentials, pool_size).get_connection()
+        except PoolError:
+            # Pool exhausted: fall back to a dedicated connection.
+            pass
+    return conn.connect(**credentials)
+
+
+def check_connection(settings: Settings):
+    for credentials in [settings.credentials, *settings.shard_credentials]:
+        connection = get_pool(credentials, settings.pool_size).get_connection()
+        try:
+            connection.ping()
+        finally:
+            connection.close()
+
+
+def warm_up_connections(settings: Settings):
+    # Opens and validates every connection of each pool, and has each one
+    # open the tables the handlers use, so neither the client nor the
+    # server table cache is cold when the first requests arrive.
+    for credentials in [settings.credentials, *settings.shard_credentials]:
+        pool = get_pool(credentials, settings.pool_size)
+        connections = []
+        try:
+            for _ in range(settings.pool_size):
+                connections.append(pool.get_connection())
+            for connection in connections:
+                connection.ping(reconnect=True)
+                with connection.cursor() as cursor:
+                    for table in [*TASK_TABLES, 'users']:
+                        cursor.execute(f'SELECT uuid FROM {table} LIMIT 1')
+                        cursor.fetchall()
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+@contextmanager
+def session_scope(deadline: Deadline = None, pooled: bool = True):
+    # Settings are a process-wide singleton, read directly rather than
+    # resolved as a dependency on every request.
+    settings = get_settings()
+
+    if settings.shards:
+        db = ShardedDBSession(
+            lambda credentials: DBSession(
+                open_connection(credentials, settings.pool_size, pooled),
+                deadline,
+            ),
+            settings,
+        )
+        try:
+            yield db
+        finally:
+            db.close()
+        return
+
+    connection = open_connection(settings.credentials, settings.pool_size, pooled)
     try:
-        connection = conn.connect(**credentials)
-        yield DBSession(connection)
+        yield DBSession(connection, deadline)
     finally:
+        # Returns pooled connections to their pool.
         connection.close()
+
+
+def get_db(request: Request):
+    with session_scope(getattr(request.state, 'deadline', None)) as db:
+        yield db
+
+
+class CoalescedReads:
+    # Runs a request's reads through the single-flight layer: identical
+    # concurrent reads share one query, on one connection, and one
+    # serialized body in the negotiated format. Only the request that runs
+    # the query takes a connection.
+    #
+    # The body is returned as a Response, which FastAPI does not check
+    # against the route's response_model. This is intended: the reads
+    # return instances of the very models the routes declare, so checking
+    # them again would only cost time. The response_model still documents
+    # the route in the OpenAPI schema.
+    def __init__(self, deadline: Deadline, encoder, headers):
+        self.deadline = deadline
+        self.encoder = encoder
+        self.headers = headers
+
+    def response(self, key: tuple, tables, read):
+        def run():
+            with session_scope(self.deadline) as db:
+                result = read(db)
+            return self.encoder.encode(result)
+
+        if get_settings().coalesce_reads:
+            body = coalescing.do((*key, self.encoder.name), tables, run, self.deadline)
+        else:
+            body = run()
+        return Response(content=body, media_type=self.encoder.media_type, headers=dict(self.headers))
+
+
+def get_coalesced_reads(request: Request, response: Response):
+    # `response` carries the headers set by other dependencies, such as
+    # Cache-Control, which a returned Response would otherwise drop.
+    return CoalescedReads(
+        getattr(request.state, 'deadline', None),
+        get_encoder(request),
+        response.headers,
+    )
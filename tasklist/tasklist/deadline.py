@@ -0,0 +1,118 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+
+from . import metrics
+from .admission import route_key
+from .compression import get_header
+from .settings import get_settings
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout
+        self.cancelled = False
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def check(self):
+        if self.cancelled or self.remaining() <= 0:
+            raise DeadlineExceeded()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def get_timeout(scope, settings):
+    timeout = settings.request_timeouts.get(route_key(scope), settings.request_timeout)
+    header = get_header(scope['headers'], b'x-request-timeout')
+    if header is not None:
+        try:
+            timeout = max(0.0, min(float(header), settings.max_request_timeout))
+        except ValueError:
+            pass
+    return timeout
+
+
+def timed_out():
+    return JSONResponse(status_code=504, content={'detail': 'Request timed out'})
+
+
+class DeadlineMiddleware:
+    # Attaches a Deadline to each request (request.state.deadline), answers
+    # 504 when it expires and stops waiting for the handler when the client
+    # disconnects. Cancellation is cooperative: DBSession checks the
+    # deadline before every statement and bounds SELECTs with
+    # MAX_EXECUTION_TIME, so abandoned requests release their connection at
+    # the next statement boundary.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timeout = get_timeout(scope, get_settings())
+        deadline = Deadline(timeout)
+        scope['state'] = {**scope.get('state', {}), 'deadline': deadline}
+
+        queue = asyncio.Queue(maxsize=1)
+        disconnected = asyncio.Event()
+        response = {'started': False, 'abandoned': False}
+
+        async def read_messages():
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                await queue.put(message)
+                if message['type'] == 'http.disconnect':
+                    return
+
+        async def send_message(message):
+            if response['abandoned']:
+                return
+            if message['type'] == 'http.response.start':
+                response['started'] = True
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, queue.get, send_message))
+        reader_task = asyncio.ensure_future(read_messages())
+        disconnect_task = asyncio.ensure_future(disconnected.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, disconnect_task},
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            reader_task.cancel()
+            disconnect_task.cancel()
+
+        if app_task in done:
+            app_task.result()
+            return
+
+        # The handler may be stuck in a worker thread, which cannot be
+        # interrupted; stop waiting for it and drop whatever it sends later.
+        deadline.cancel()
+        response['abandoned'] = True
+        app_task.cancel()
+        app_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        if disconnect_task in done:
+            metrics.increment('requests_cancelled_total', route=route_key(scope))
+            return
+
+        metrics.increment('request_timeouts_total', route=route_key(scope))
+        if not response['started']:
+            await timed_out()(scope, receive, send)
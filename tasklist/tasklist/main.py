@@ -1,7 +1,16 @@
 # pylint: disable=missing-module-docstring
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-from .routers import task, user
+from . import metrics, warmup
+
+from .admission import AdmissionMiddleware, route_key
+from .compression import CompressionMiddleware
+from .database import check_connection
+from .deadline import DeadlineExceeded, DeadlineMiddleware, timed_out
+from .profiling import SlowRequestMiddleware
+from .routers import debug, task, user
+from .settings import get_settings
 
 tags_metadata = [
     {
@@ -20,5 +29,51 @@ app = FastAPI(
     openapi_tags=tags_metadata,
 )
 
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(SlowRequestMiddleware)
+app.add_middleware(AdmissionMiddleware)
+
 app.include_router(task.router, prefix='/task', tags=['task'])
-app.include_router(user.router, prefix='/user', tags=['user'])
\ No newline at end of file
+app.include_router(user.router, prefix='/user', tags=['user'])
+app.include_router(debug.router, prefix='/debug', include_in_schema=False)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def handle_deadline_exceeded(request: Request, exception: DeadlineExceeded):
+    # Requests abandoned by DeadlineMiddleware were already counted there.
+    if not request.state.deadline.cancelled:
+        metrics.increment('request_timeouts_total', route=route_key(request.scope))
+    return timed_out()
+
+
+@app.get('/metrics', include_in_schema=False, response_class=PlainTextResponse)
+def read_metrics():
+    return metrics.render()
+
+
+@app.on_event('startup')
+def check_settings():
+    # Fail at boot, not on the first request, when the configuration is
+    # invalid or the database is unreachable.
+    check_connection(get_settings())
+
+
+@app.on_event('startup')
+def start_warm_up():
+    warmup.start(app)
+
+
+# The probes are async so that they answer even when every thread of the
+# pool running the handlers is busy.
+@app.get('/live', include_in_schema=False)
+async def read_liveness():
+    return {'live': True}
+
+
+@app.get('/ready', include_in_schema=False)
+async def read_readiness():
+    status = warmup.status()
+    if not status['ready']:
+        return JSONResponse(status_code=503, content=status)
+    return status
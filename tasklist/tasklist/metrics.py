@@ -0,0 +1,32 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+import threading
+
+from collections import Counter
+
+# In-process counters, exposed in the Prometheus text format at /metrics.
+# Each worker process reports its own values.
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def increment(name: str, amount: float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += amount
+
+
+def get(name: str, **labels):
+    return _counters[(name, tuple(sorted(labels.items())))]
+
+
+def render():
+    lines = []
+    with _lock:
+        items = sorted(_counters.items())
+    for (name, labels), value in items:
+        if labels:
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels)
+            lines.append(f'{name}{{{label_text}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
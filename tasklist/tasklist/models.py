@@ -1,6 +1,6 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring
-from typing import Optional
-from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field, validator  # pylint: disable=no-name-in-module
 import uuid
 
 # pylint: disable=too-few-public-methods
@@ -41,3 +41,106 @@ class User(BaseModel):
                 'name': 'giovanna',
             }
         }
+
+
+class UserWithCounts(User):
+    task_count: int = Field(
+        title='Number of tasks assigned to the user',
+    )
+    open_task_count: int = Field(
+        title='Number of tasks assigned to the user and not completed',
+    )
+
+
+class TaskBatch(BaseModel):
+    found: Dict[uuid.UUID, Task] = Field(
+        title='Tasks found, keyed by UUID',
+    )
+    missing: List[uuid.UUID] = Field(
+        title='Requested UUIDs that do not match any task',
+    )
+
+
+class UserBatch(BaseModel):
+    found: Dict[uuid.UUID, User] = Field(
+        title='Users found, keyed by UUID',
+    )
+    missing: List[uuid.UUID] = Field(
+        title='Requested UUIDs that do not match any user',
+    )
+
+
+class ImportResult(BaseModel):
+    rows: int = Field(title='Number of rows imported')
+    seconds: float = Field(title='Time spent inserting the rows')
+    rows_per_second: float = Field(title='Import throughput')
+
+
+class TaskFilter(BaseModel):
+    user_uuid: Optional[uuid.UUID] = Field(
+        None,
+        title='Only tasks assigned to this user',
+    )
+    completed: Optional[bool] = Field(
+        None,
+        title='Only tasks with this completion status',
+    )
+    uuids: Optional[List[uuid.UUID]] = Field(
+        None,
+        title='Only the tasks with these UUIDs',
+    )
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'user_uuid': '3668e9c9-df18-4ce2-9bb2-82f907cf110c',
+                'completed': False,
+            }
+        }
+
+
+class TaskUpdate(BaseModel):
+    description: Optional[str] = Field(
+        None,
+        title='New task description',
+        max_length=1024,
+    )
+    completed: Optional[bool] = Field(
+        None,
+        title='New completion status',
+    )
+    user_uuid: Optional[uuid.UUID] = Field(
+        None,
+        title='UUID of the new user in charge of the tasks',
+    )
+
+    # Fields are optional so they can be left out, but none may be null.
+    @validator('*', pre=True)
+    def not_null(cls, value):  # pylint: disable=no-self-argument
+        if value is None:
+            raise ValueError('may not be null')
+        return value
+
+
+class TaskBulkUpdate(BaseModel):
+    filter: TaskFilter = Field(title='Which tasks to alter')
+    update: TaskUpdate = Field(title='Fields to set; fields left out are kept')
+    all_tasks: bool = Field(
+        False,
+        title='Must be true to alter every task with an empty filter',
+    )
+
+    class Config:
+        schema_extra = {
+            'example': {
+                'filter': {
+                    'user_uuid': '3668e9c9-df18-4ce2-9bb2-82f907cf110c',
+                    'completed': False,
+                },
+                'update': {'completed': True},
+            }
+        }
+
+
+class BulkResult(BaseModel):
+    affected: int = Field(title='Number of rows affected')
@@ -0,0 +1,240 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods, protected-access
+#
+# In-process sampling profiler and slow-request capture, served under
+# /debug (see routers.debug). Stacks are reported in the collapsed format
+# read by flamegraph.pl, speedscope and similar tools: one line per
+# distinct stack, frames separated by semicolons root first, followed by
+# the number of samples.
+import contextvars
+import random
+import re
+import sys
+import threading
+import time
+
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from . import metrics
+from .admission import route_key
+from .settings import get_settings
+
+# Queries kept per trace; bulk operations can run thousands.
+MAX_TRACE_QUERIES = 1000
+MAX_QUERY_LENGTH = 500
+
+_labels = {}
+
+
+def frame_label(item):
+    # Stacks hold code objects, which unlike frames are long-lived and cheap
+    # to keep, so samples are aggregated on them and formatted on output.
+    if isinstance(item, str):
+        return item
+    label = _labels.get(item)
+    if label is None:
+        label = f'{item.co_name} ({item.co_filename}:{item.co_firstlineno})'
+        _labels[item] = label
+    return label
+
+
+def stack_key(frame):
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    return tuple(reversed(codes))
+
+
+def render_collapsed(samples: Counter):
+    return ''.join(
+        ';'.join(map(frame_label, stack)) + f' {count}\n'
+        for stack, count in samples.most_common()
+    )
+
+
+def thread_group(thread_name):
+    # Pool threads differ only by a numeric suffix; merge them.
+    return re.sub(r'[-_\d]+$', '', thread_name) or thread_name
+
+
+#on-demand profiling
+
+class ProfilerBusy(Exception):
+    pass
+
+
+_profile_lock = threading.Lock()
+
+
+def profile(seconds: float, interval: float):
+    # Samples the stacks of every thread of the worker, the event loop's
+    # included, every `interval` seconds. Only one profile runs at a time.
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        samples = Counter()
+        own_thread = threading.get_ident()
+        ends_at = time.monotonic() + seconds
+        while time.monotonic() < ends_at:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_thread:
+                    continue
+                group = thread_group(names.get(ident, str(ident)))
+                samples[(group, *stack_key(frame))] += 1
+            time.sleep(interval)
+        return render_collapsed(samples)
+    finally:
+        _profile_lock.release()
+
+
+#slow-request capture
+
+class Trace:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.status = None
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.queries = []
+        self.dropped_queries = 0
+        self.thread_ids = set()
+        self.samples = Counter()
+
+    def add_query(self, query: str, seconds: float):
+        self.thread_ids.add(threading.get_ident())
+        if len(self.queries) >= MAX_TRACE_QUERIES:
+            self.dropped_queries += 1
+            return
+        self.queries.append({
+            'sql': ' '.join(query.split())[:MAX_QUERY_LENGTH],
+            'seconds': seconds,
+        })
+
+    def to_dict(self, seconds: float):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'started_at': self.started_at.isoformat(),
+            'seconds': seconds,
+            'queries': list(self.queries),
+            'dropped_queries': self.dropped_queries,
+            'stacks': render_collapsed(self.samples),
+        }
+
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def record_query(query: str, seconds: float):
+    # Called by DBSession for every statement; a no-op outside traced
+    # requests, e.g. in scripts.
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_query(query, seconds)
+
+
+class StackSampler:
+    # Samples, while any traced request is in flight, the stacks of the
+    # threads that ran its queries. The event loop thread is shared by all
+    # requests, so its samples cannot be attributed and are left out.
+    def __init__(self):
+        self.traces = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, trace: Trace, interval: float):
+        with self.lock:
+            self.traces.add(trace)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run,
+                    args=(interval, ),
+                    name='slow-request-sampler',
+                    daemon=True,
+                )
+                self.thread.start()
+
+    def remove(self, trace: Trace):
+        with self.lock:
+            self.traces.discard(trace)
+
+    def run(self, interval: float):
+        while True:
+            time.sleep(interval)
+            # Sampling under the lock means a trace is no longer written to
+            # once remove() returns.
+            with self.lock:
+                if not self.traces:
+                    self.thread = None
+                    return
+                frames = sys._current_frames()
+                for trace in self.traces:
+                    for ident in list(trace.thread_ids):
+                        frame = frames.get(ident)
+                        if frame is not None:
+                            trace.samples[stack_key(frame)] += 1
+                del frames
+
+
+_sampler = StackSampler()
+_slow_requests = deque(maxlen=1)
+
+
+def get_slow_requests():
+    return list(reversed(_slow_requests))
+
+
+def store_slow_request(entry: dict, buffer_size: int):
+    global _slow_requests  # pylint: disable=global-statement
+    if _slow_requests.maxlen != buffer_size:
+        _slow_requests = deque(_slow_requests, maxlen=buffer_size)
+    _slow_requests.append(entry)
+
+
+def clear_slow_requests():
+    _slow_requests.clear()
+
+
+class SlowRequestMiddleware:
+    # When slow_request_threshold is set, traces a slow_request_sample_rate
+    # fraction of the requests (queries with their timings and stack
+    # samples) and keeps the traces of those slower than the threshold in a
+    # bounded ring buffer, newest first at /debug/slow. Off by default:
+    # tracing keeps the sampler thread busy while requests are in flight.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        settings = get_settings()
+        if (
+                scope['type'] != 'http'
+                or settings.slow_request_threshold is None
+                or scope['path'].startswith('/debug/')
+                or random.random() >= settings.slow_request_sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope['method'], scope['path'])
+        token = _current_trace.set(trace)
+        _sampler.add(trace, settings.slow_request_sample_interval)
+
+        async def send_message(message):
+            if message['type'] == 'http.response.start':
+                trace.status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_message)
+        finally:
+            _sampler.remove(trace)
+            _current_trace.reset(token)
+            seconds = time.monotonic() - trace.started
+            if seconds >= settings.slow_request_threshold:
+                store_slow_request(trace.to_dict(seconds), settings.slow_request_buffer_size)
+                metrics.increment('slow_requests_total', route=route_key(scope))
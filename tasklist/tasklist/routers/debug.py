@@ -0,0 +1,61 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+import hmac
+
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from .. import profiling
+from ..settings import get_settings
+
+
+def require_admin(x_api_key: Optional[str] = Header(None)):
+    if x_api_key is None or not any(
+            hmac.compare_digest(x_api_key, key)
+            for key in get_settings().admin_api_keys
+    ):
+        raise HTTPException(
+            status_code=403,
+            detail='Admin API key required',
+        )
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get(
+    '/profile',
+    summary='Profiles the worker',
+    description='Samples the stacks of every thread of the worker that serves '
+    'the request for the given number of seconds and returns them as collapsed '
+    'stacks, ready for flamegraph.pl or speedscope.',
+    response_class=PlainTextResponse,
+)
+async def read_profile(seconds: float = Query(10.0, gt=0)):
+    settings = get_settings()
+    try:
+        # Sampled from a pool thread, so the event loop keeps running and
+        # shows up in the profile.
+        return await run_in_threadpool(
+            profiling.profile,
+            min(seconds, settings.profile_max_seconds),
+            settings.profile_interval,
+        )
+    except profiling.ProfilerBusy as exception:
+        raise HTTPException(
+            status_code=409,
+            detail='A profile is already running',
+        ) from exception
+
+
+@router.get(
+    '/slow',
+    summary='Reads slow requests',
+    description='Returns the traces of the latest requests slower than '
+    'slow_request_threshold, newest first: their queries with timings and '
+    'collapsed stack samples.',
+)
+async def read_slow_requests():
+    return profiling.get_slow_requests()
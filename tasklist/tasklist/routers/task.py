@@ -1,24 +1,38 @@
 # pylint: disable=missing-module-docstring, missing-function-docstring, invalid-name
 import uuid
 
-from typing import Dict
+from typing import Dict, List
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Request
 
-from ..database import DBSession, get_db
-from ..models import Task
+from ..bulk import TASK_COLUMNS, DataFormat, decode_task, export_response, import_request
+from ..caching import cache_control
+from ..database import TASK_TABLES, CoalescedReads, DBSession, get_coalesced_reads, get_db
+from ..models import BulkResult, ImportResult, Task, TaskBatch, TaskBulkUpdate, TaskFilter
+from ..serialization import MsgpackRoute, negotiated
+from ..settings import get_settings
 
-router = APIRouter()
+router = APIRouter(route_class=MsgpackRoute)
 
 
 @router.get(
     '',
     summary='Reads task list',
-    description='Reads the whole task list.',
+    description='Reads the whole task list. Completed tasks that were moved to '
+    'the archive are only included with include_archived=true.',
     response_model=Dict[uuid.UUID, Task],
+    dependencies=[Depends(cache_control('read_tasks', 'private, no-cache'))],
 )
-async def read_tasks(completed: bool = None, db: DBSession = Depends(get_db)):
-    return db.read_tasks(completed)
+def read_tasks(
+        completed: bool = None,
+        include_archived: bool = False,
+        reads: CoalescedReads = Depends(get_coalesced_reads),
+):
+    return reads.response(
+        ('read_tasks', completed, include_archived),
+        TASK_TABLES,
+        lambda db: db.read_tasks(completed, include_archived),
+    )
 
 
 @router.post(
@@ -27,8 +41,49 @@ async def read_tasks(completed: bool = None, db: DBSession = Depends(get_db)):
     description='Creates a new task and returns its UUID.',
     response_model=uuid.UUID,
 )
-async def create_task(item: Task, db: DBSession = Depends(get_db)):
-    return db.create_task(item)
+def create_task(request: Request, item: Task, db: DBSession = Depends(get_db)):
+    return negotiated(request, db.create_task(item))
+
+
+@router.post(
+    '/batch-get',
+    summary='Reads several tasks',
+    description='Reads the tasks identified by a list of UUIDs in a single query. '
+    'Returns the tasks found, keyed by UUID, and the UUIDs that were not found.',
+    response_model=TaskBatch,
+)
+def read_tasks_batch(
+        request: Request,
+        uuids: List[uuid.UUID] = Body(...),
+        db: DBSession = Depends(get_db),
+):
+    found, missing = db.read_tasks_by_uuid(uuids)
+    return negotiated(request, TaskBatch(found=found, missing=missing))
+
+
+@router.get(
+    '/export',
+    summary='Exports all tasks',
+    description='Streams all tasks as CSV, NDJSON, Parquet or MessagePack, reading '
+    'them from the database in fixed-size chunks.',
+)
+def export_tasks(format: DataFormat = DataFormat.NDJSON):  # pylint: disable=redefined-builtin
+    return export_response('iter_tasks', TASK_COLUMNS, format, 'tasks')
+
+
+@router.post(
+    '/import',
+    summary='Imports tasks',
+    description='Loads tasks from a CSV, NDJSON, Parquet or MessagePack file in the '
+    'request body, with batched inserts. Rows without a UUID get a new one.',
+    response_model=ImportResult,
+)
+async def import_tasks(
+        request: Request,
+        format: DataFormat = DataFormat.NDJSON,  # pylint: disable=redefined-builtin
+        db: DBSession = Depends(get_db),
+):
+    return negotiated(request, await import_request(request, format, db.import_tasks, decode_task))
 
 
 @router.get(
@@ -36,10 +91,11 @@ async def create_task(item: Task, db: DBSession = Depends(get_db)):
     summary='Reads task',
     description='Reads task from UUID.',
     response_model=Task,
+    dependencies=[Depends(cache_control('read_task', 'private, no-cache'))],
 )
-async def read_task(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
+def read_task(uuid_: uuid.UUID, reads: CoalescedReads = Depends(get_coalesced_reads)):
     try:
-        return db.read_task(uuid_)
+        return reads.response(('read_task', uuid_), TASK_TABLES, lambda db: db.read_task(uuid_))
     except KeyError as exception:
         raise HTTPException(
             status_code=404,
@@ -52,7 +108,7 @@ async def read_task(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
     summary='Replaces a task',
     description='Replaces a task identified by its UUID.',
 )
-async def replace_task(
+def replace_task(
         uuid_: uuid.UUID,
         item: Task,
         db: DBSession = Depends(get_db),
@@ -71,7 +127,7 @@ async def replace_task(
     summary='Alters task',
     description='Alters a task identified by its UUID',
 )
-async def alter_task(
+def alter_task(
         uuid_: uuid.UUID,
         item: Task,
         db: DBSession = Depends(get_db),
@@ -93,7 +149,7 @@ async def alter_task(
     summary='Deletes task',
     description='Deletes a task identified by its UUID',
 )
-async def remove_task(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
+def remove_task(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
     try:
         db.remove_task(uuid_)
     except KeyError as exception:
@@ -103,10 +159,52 @@ async def remove_task(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
         ) from exception
 
 
+@router.patch(
+    '',
+    summary='Alters tasks by filter',
+    description='Sets the given fields on every task matching the filter, with '
+    'set-based updates. An empty filter is refused unless all_tasks is true. '
+    'Returns the number of tasks altered.',
+    response_model=BulkResult,
+)
+def alter_tasks(request: Request, item: TaskBulkUpdate, db: DBSession = Depends(get_db)):
+    update = item.update.dict(exclude_unset=True)
+    if not update:
+        raise HTTPException(
+            status_code=422,
+            detail='No fields to update',
+        )
+    if not item.filter.dict(exclude_none=True) and not item.all_tasks:
+        raise HTTPException(
+            status_code=422,
+            detail='Empty filter: set all_tasks to alter every task',
+        )
+    chunk_size = get_settings().bulk_chunk_size
+    return negotiated(request, BulkResult(affected=db.update_tasks(item.filter, update, chunk_size)))
+
+
 @router.delete(
     '',
-    summary='Deletes all tasks, use with caution',
-    description='Deletes all tasks, use with caution',
+    summary='Deletes tasks by filter, or all tasks, use with caution',
+    description='Deletes the tasks matching the filter in the body, or all tasks '
+    'when there is no body, use with caution. An empty filter is refused unless '
+    'all_tasks is true. Returns the number of tasks deleted.',
+    response_model=BulkResult,
 )
-async def remove_all_tasks(db: DBSession = Depends(get_db)):
-    db.remove_all_tasks()
+def remove_all_tasks(
+        request: Request,
+        task_filter: TaskFilter = Body(None),
+        all_tasks: bool = False,
+        db: DBSession = Depends(get_db),
+):
+    if task_filter is not None and not task_filter.dict(exclude_none=True):
+        if not all_tasks:
+            raise HTTPException(
+                status_code=422,
+                detail='Empty filter: set all_tasks to delete every task',
+            )
+        task_filter = None
+    if task_filter is None:
+        return negotiated(request, BulkResult(affected=db.remove_all_tasks()))
+    chunk_size = get_settings().bulk_chunk_size
+    return negotiated(request, BulkResult(affected=db.remove_tasks(task_filter, chunk_size)))
@@ -1,24 +1,36 @@
 # pylint: disable=missing-module-docstring, missing-function-docstring, invalid-name
 import uuid
 
-from typing import Dict
+from typing import Dict, List, Union
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, Body, HTTPException, Depends, Request
 
-from ..database import DBSession, get_db
-from ..models import User
+from ..bulk import USER_COLUMNS, DataFormat, decode_user, export_response, import_request
+from ..caching import cache_control
+from ..database import CoalescedReads, DBSession, get_coalesced_reads, get_db
+from ..models import ImportResult, User, UserBatch, UserWithCounts
+from ..serialization import MsgpackRoute, negotiated
 
-router = APIRouter()
+router = APIRouter(route_class=MsgpackRoute)
 
 
 @router.get(
     '',
     summary='Reads user list',
-    description='Reads the whole user list.',
-    response_model=Dict[uuid.UUID, User],
+    description='Reads the whole user list. With `include_counts`, each user '
+    'also carries its total and open task counts, at no extra cost.',
+    response_model=Dict[uuid.UUID, Union[UserWithCounts, User]],
+    dependencies=[Depends(cache_control('read_users', 'private, no-cache'))],
 )
-async def read_users(db: DBSession = Depends(get_db)):
-    return db.read_users()
+def read_users(
+        include_counts: bool = False,
+        reads: CoalescedReads = Depends(get_coalesced_reads),
+):
+    return reads.response(
+        ('read_users', include_counts),
+        ['users'],
+        lambda db: db.read_users(include_counts),
+    )
 
 
 @router.post(
@@ -27,8 +39,49 @@ async def read_users(db: DBSession = Depends(get_db)):
     description='Creates a new user and returns its UUID.',
     response_model=uuid.UUID,
 )
-async def create_user(item: User, db: DBSession = Depends(get_db)):
-    return db.create_user(item)
+def create_user(request: Request, item: User, db: DBSession = Depends(get_db)):
+    return negotiated(request, db.create_user(item))
+
+
+@router.post(
+    '/batch-get',
+    summary='Reads several users',
+    description='Reads the users identified by a list of UUIDs in a single query. '
+    'Returns the users found, keyed by UUID, and the UUIDs that were not found.',
+    response_model=UserBatch,
+)
+def read_users_batch(
+        request: Request,
+        uuids: List[uuid.UUID] = Body(...),
+        db: DBSession = Depends(get_db),
+):
+    found, missing = db.read_users_by_uuid(uuids)
+    return negotiated(request, UserBatch(found=found, missing=missing))
+
+
+@router.get(
+    '/export',
+    summary='Exports all users',
+    description='Streams all users as CSV, NDJSON, Parquet or MessagePack, reading '
+    'them from the database in fixed-size chunks.',
+)
+def export_users(format: DataFormat = DataFormat.NDJSON):  # pylint: disable=redefined-builtin
+    return export_response('iter_users', USER_COLUMNS, format, 'users')
+
+
+@router.post(
+    '/import',
+    summary='Imports users',
+    description='Loads users from a CSV, NDJSON, Parquet or MessagePack file in the '
+    'request body, with batched inserts. Rows without a UUID get a new one.',
+    response_model=ImportResult,
+)
+async def import_users(
+        request: Request,
+        format: DataFormat = DataFormat.NDJSON,  # pylint: disable=redefined-builtin
+        db: DBSession = Depends(get_db),
+):
+    return negotiated(request, await import_request(request, format, db.import_users, decode_user))
 
 
 @router.get(
@@ -36,10 +89,11 @@ async def create_user(item: User, db: DBSession = Depends(get_db)):
     summary='Reads user',
     description='Reads user from UUID.',
     response_model=User,
+    dependencies=[Depends(cache_control('read_user', 'private, no-cache'))],
 )
-async def read_user(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
+def read_user(uuid_: uuid.UUID, reads: CoalescedReads = Depends(get_coalesced_reads)):
     try:
-        return db.read_user(uuid_)
+        return reads.response(('read_user', uuid_), ['users'], lambda db: db.read_user(uuid_))
     except KeyError as exception:
         raise HTTPException(
             status_code=404,
@@ -52,7 +106,7 @@ async def read_user(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
     summary='Replaces a user',
     description='Replaces a user identified by its UUID.',
 )
-async def replace_task(
+def replace_task(
         uuid_: uuid.UUID,
         item: User,
         db: DBSession = Depends(get_db),
@@ -71,7 +125,7 @@ async def replace_task(
     summary='Alters user',
     description='Alters a user identified by its UUID',
 )
-async def alter_user(
+def alter_user(
         uuid_: uuid.UUID,
         item: User,
         db: DBSession = Depends(get_db),
@@ -93,7 +147,7 @@ async def alter_user(
     summary='Deletes user',
     description='Deletes a user identified by its UUID',
 )
-async def remove_user(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
+def remove_user(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
     try:
         db.remove_user(uuid_)
     except KeyError as exception:
@@ -108,5 +162,5 @@ async def remove_user(uuid_: uuid.UUID, db: DBSession = Depends(get_db)):
     summary='Deletes all users, use with caution',
     description='Deletes all users, use with caution',
 )
-async def remove_all_users(db: DBSession = Depends(get_db)):
+def remove_all_users(db: DBSession = Depends(get_db)):
     db.remove_all_users()
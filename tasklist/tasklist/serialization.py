@@ -0,0 +1,176 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods
+#
+# Response format negotiation. JSON is the default; clients that send
+# `Accept: application/msgpack` get MessagePack instead, with UUIDs as
+# 16-byte binaries, and `Accept: application/msgpack; layout=columnar`
+# turns maps of UUID to item into one array per field:
+#
+#     {'uuid': [...], 'description': [...], 'completed': [...], 'user_uuid': [...]}
+#
+# Request bodies sent with `Content-Type: application/msgpack` are accepted
+# by the routes of routers using MsgpackRoute.
+import json
+import uuid
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from pydantic import BaseModel  # pylint: disable=no-name-in-module
+
+try:
+    import msgpack
+except ImportError:  # MessagePack support is optional
+    msgpack = None
+
+JSON_MEDIA_TYPE = 'application/json'
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, 'application/x-msgpack')
+
+
+class JSONEncoder:
+    name = 'json'
+    media_type = JSON_MEDIA_TYPE
+
+    @staticmethod
+    def encode(value):
+        # Same output as FastAPI's JSONResponse.
+        return json.dumps(
+            jsonable_encoder(value),
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(',', ':'),
+        ).encode('utf-8')
+
+
+class MsgpackEncoder:
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def __init__(self, columnar: bool = False):
+        self.columnar = columnar
+        self.name = 'msgpack-columnar' if columnar else 'msgpack'
+
+    def encode(self, value):
+        return msgpack.packb(self.convert(value), use_bin_type=True)
+
+    def convert(self, value):
+        if isinstance(value, uuid.UUID):
+            return value.bytes
+        if isinstance(value, BaseModel):
+            return self.convert(value.dict())
+        if isinstance(value, dict):
+            if self.columnar and is_item_map(value):
+                return self.to_columns(value)
+            return {self.convert(key): self.convert(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.convert(item) for item in value]
+        return value
+
+    def to_columns(self, items):
+        columns = {'uuid': [uuid_.bytes for uuid_ in items]}
+        for item in items.values():
+            for field, field_value in item.dict().items():
+                columns.setdefault(field, []).append(self.convert(field_value))
+        return columns
+
+
+JSON = JSONEncoder()
+
+
+def is_item_map(value):
+    return bool(value) and all(
+        isinstance(key, uuid.UUID) and isinstance(item, BaseModel)
+        for key, item in value.items()
+    )
+
+
+def get_encoder(request: Request):
+    # Picks the supported media type with the highest quality in Accept;
+    # JSON wins ties and is used when nothing else matches.
+    best, best_quality = JSON, 0.0
+    for media_range in request.headers.get('accept', '').split(','):
+        media_type, *parameters = [part.strip() for part in media_range.split(';')]
+        options = {}
+        for parameter in parameters:
+            key, _, option = parameter.partition('=')
+            options[key.strip().lower()] = option.strip().strip('"')
+        try:
+            quality = float(options.get('q', 1.0))
+        except ValueError:
+            quality = 0.0
+        media_type = media_type.lower()
+        if media_type == JSON_MEDIA_TYPE and quality >= best_quality:
+            best, best_quality = JSON, quality
+        elif media_type in MSGPACK_MEDIA_TYPES and msgpack is not None and quality > best_quality:
+            best = MsgpackEncoder(columnar=options.get('layout') == 'columnar')
+            best_quality = quality
+    return best
+
+
+def negotiated(request: Request, value):
+    # JSON results are returned as is, so FastAPI validates them against
+    # the route's response_model as usual.
+    encoder = get_encoder(request)
+    if encoder is JSON:
+        return value
+    return Response(content=encoder.encode(value), media_type=encoder.media_type)
+
+
+def from_msgpack(value):
+    # Binaries in request bodies can only be UUIDs.
+    if isinstance(value, bytes) and len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    if isinstance(value, dict):
+        return {from_msgpack(key): from_msgpack(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_msgpack(item) for item in value]
+    return value
+
+
+def is_msgpack(content_type):
+    return (content_type or '').split(';')[0].strip().lower() in MSGPACK_MEDIA_TYPES
+
+
+class MsgpackRoute(APIRoute):
+    # Decodes MessagePack request bodies and hands them to FastAPI as if
+    # they had been sent as JSON, so the usual validation applies. Routes
+    # without a body field, such as the imports, read the stream
+    # themselves and get the request untouched. Marks every response as
+    # varying with Accept.
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            if self.body_field is not None and is_msgpack(request.headers.get('content-type')):
+                request = await as_json_request(request)
+            response = await handler(request)
+            response.headers.append('Vary', 'Accept')
+            return response
+
+        return route_handler
+
+
+async def as_json_request(request: Request):
+    if msgpack is None:
+        raise HTTPException(
+            status_code=415,
+            detail='MessagePack support requires the msgpack package',
+        )
+    body = await request.body()
+    try:
+        value = from_msgpack(msgpack.unpackb(body, raw=False, strict_map_key=False))
+    except (ValueError, TypeError) as exception:
+        raise HTTPException(
+            status_code=400,
+            detail='Invalid MessagePack body',
+        ) from exception
+    headers = [
+        (key, header) for key, header in request.scope['headers']
+        if key.lower() != b'content-type'
+    ]
+    headers.append((b'content-type', JSON_MEDIA_TYPE.encode('latin-1')))
+    json_request = Request({**request.scope, 'headers': headers}, request.receive)
+    # Already read and decoded: FastAPI takes them from these caches.
+    json_request._body = body  # pylint: disable=protected-access
+    json_request._json = value  # pylint: disable=protected-access
+    return json_request
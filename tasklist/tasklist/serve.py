@@ -0,0 +1,100 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=abstract-method, unused-argument
+#
+# Production entry point:
+#
+#     python -m tasklist.serve [--workers N] [--bind HOST:PORT]
+#
+# Runs the app under gunicorn with uvicorn workers. The app, config and
+# credentials are loaded once in the master process and shared with the
+# workers through fork(); each worker opens its own connection pool after
+# forking. Signals handled by the master:
+#
+#     HUP          graceful restart of all workers
+#     TTIN / TTOU  add / remove one worker
+#     TERM         graceful shutdown
+#
+# Sending USR2 to a worker makes it reload the settings files, e.g. after
+# rotating the database secrets, without restarting it.
+import multiprocessing
+import signal
+
+from argparse import ArgumentParser
+
+from gunicorn.app.base import BaseApplication
+
+from . import database
+from .main import app
+from .settings import load_settings, reload_settings
+
+DEFAULT_SERVER_CONFIG = {
+    'bind': '0.0.0.0:8000',
+    'workers': None,
+    'graceful_timeout': 30,
+    'timeout': 60,
+    'keepalive': 5,
+    'max_requests': 0,
+    'max_requests_jitter': 0,
+}
+
+
+def post_fork(server, worker):
+    database.reset_pools()
+
+
+def handle_reload(signum, frame):
+    reload_settings()
+    database.reset_pools()
+
+
+def post_worker_init(worker):
+    signal.signal(signal.SIGUSR2, handle_reload)
+
+
+class Server(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def get_server_config(settings):
+    server_config = {**DEFAULT_SERVER_CONFIG, **settings.server}
+    if not server_config['workers']:
+        server_config['workers'] = multiprocessing.cpu_count()
+    return server_config
+
+
+def main():
+    parser = ArgumentParser(description='Run the task list service.')
+    parser.add_argument('--workers', type=int, help='Number of worker processes')
+    parser.add_argument('--bind', help='Address to listen on, as HOST:PORT')
+    args = parser.parse_args()
+
+    # Load and validate the settings in the master, so workers inherit them
+    # and a broken configuration stops the deploy before any fork.
+    settings = load_settings()
+    server_config = get_server_config(settings)
+    if args.workers:
+        server_config['workers'] = args.workers
+    if args.bind:
+        server_config['bind'] = args.bind
+
+    Server(app, {
+        **server_config,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
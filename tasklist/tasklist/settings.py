@@ -0,0 +1,279 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint: disable=too-few-public-methods, global-statement
+import json
+import os
+import os.path
+
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, BaseSettings, Field  # pylint: disable=no-name-in-module
+
+from utils.utils import get_config_filename, get_app_secrets_filename
+
+
+class ShardSettings(BaseModel):
+    db_host: str = Field(title='MySQL host of the shard')
+    database: str = Field(title='MySQL database of the shard')
+    db_user: Optional[str] = Field(None, title='MySQL user, if not the main one')
+    db_password: Optional[str] = Field(None, title='MySQL password, if not the main one')
+
+
+class Settings(BaseSettings):
+    db_host: str = Field(title='MySQL host')
+    database: str = Field(title='MySQL database name')
+    db_user: str = Field(title='MySQL user')
+    db_password: str = Field(title='MySQL password')
+    pool_size: int = Field(
+        5,
+        title='Connections kept open per worker process',
+        gt=0,
+    )
+    compression_minimum_size: int = Field(
+        1024,
+        title='Responses smaller than this many bytes are sent uncompressed',
+        ge=0,
+    )
+    compression_gzip_level: int = Field(6, title='gzip compression level', ge=1, le=9)
+    compression_brotli: bool = Field(
+        True,
+        title='Prefer brotli over gzip when the client and server support it',
+    )
+    compression_brotli_quality: int = Field(4, title='brotli quality', ge=0, le=11)
+    cache_control: Dict[str, str] = Field(
+        {},
+        title='Cache-Control header per route name, overriding the route default',
+    )
+    admission_enabled: bool = Field(True, title='Enable rate limiting and concurrency caps')
+    admission_exempt_paths: List[str] = Field(
+        ['/docs', '/redoc', '/openapi.json', '/metrics', '/live', '/ready'],
+        title='Paths that bypass admission control',
+    )
+    rate_limit_rate: float = Field(
+        50.0,
+        title='Tokens per second refilled in each client bucket',
+        gt=0,
+    )
+    rate_limit_burst: float = Field(
+        100.0,
+        title='Maximum tokens in each client bucket',
+        gt=0,
+    )
+    rate_limit_costs: Dict[str, float] = Field(
+        {
+            'GET /task': 10.0,
+            'GET /user': 10.0,
+            'GET /task/export': 50.0,
+            'GET /user/export': 50.0,
+            'POST /task/import': 50.0,
+            'POST /user/import': 50.0,
+        },
+        title='Tokens taken per request, keyed by "METHOD /path"; other routes cost 1',
+    )
+    api_keys: List[str] = Field(
+        [],
+        title='X-API-Key values that get their own rate limit bucket; other clients are '
+        'limited by address. Keep them in the secrets file',
+    )
+    max_concurrency: int = Field(
+        32,
+        title='Requests allowed in flight at once per worker, 0 for no limit',
+        ge=0,
+    )
+    admission_queue_timeout: float = Field(
+        0.5,
+        title='Seconds a request waits for a concurrency slot before a 429',
+        ge=0,
+    )
+    request_timeout: float = Field(
+        10.0,
+        title='Default seconds before a request is answered with 504',
+        gt=0,
+    )
+    request_timeouts: Dict[str, float] = Field(
+        {
+            'GET /task': 30.0,
+            'GET /user': 30.0,
+            'GET /task/export': 3600.0,
+            'GET /user/export': 3600.0,
+            'POST /task/import': 3600.0,
+            'POST /user/import': 3600.0,
+            'GET /debug/profile': 90.0,
+        },
+        title='Request timeout in seconds, keyed by "METHOD /path"',
+    )
+    max_request_timeout: float = Field(
+        60.0,
+        title='Upper bound for timeouts requested through X-Request-Timeout',
+        gt=0,
+    )
+    bulk_chunk_size: int = Field(
+        1000,
+        title='Rows per chunk in bulk exports, imports and set-based writes',
+        gt=0,
+    )
+    archive_after_seconds: float = Field(
+        30 * 24 * 3600,
+        title='Age in seconds after which completed tasks are moved to the archive',
+        ge=0,
+    )
+    archive_batch_size: int = Field(
+        500,
+        title='Tasks moved to the archive per transaction',
+        gt=0,
+    )
+    archive_pause: float = Field(
+        0.1,
+        title='Pause in seconds between archival batches',
+        ge=0,
+    )
+    warmup_preload: bool = Field(
+        False,
+        title='Read the users and open tasks at startup, loading their pages '
+        'into the database buffer pool',
+    )
+    warmup_retry_interval: float = Field(
+        5.0,
+        title='Seconds to wait before retrying a failed startup warm-up',
+        gt=0,
+    )
+    coalesce_reads: bool = Field(
+        True,
+        title='Let identical concurrent reads of the task and user lists and items share one query',
+    )
+    admin_api_keys: List[str] = Field(
+        [],
+        title='X-API-Key values allowed to use the /debug endpoints; keep them in the secrets file',
+    )
+    profile_max_seconds: float = Field(
+        60.0,
+        title='Upper bound for the duration of /debug/profile',
+        gt=0,
+    )
+    profile_interval: float = Field(
+        0.01,
+        title='Seconds between stack samples in /debug/profile',
+        gt=0,
+    )
+    slow_request_threshold: Optional[float] = Field(
+        None,
+        title='Requests slower than this many seconds are kept at /debug/slow; null (the default) '
+        'disables tracing',
+        ge=0,
+    )
+    slow_request_sample_rate: float = Field(
+        1.0,
+        title='Fraction of requests traced while slow_request_threshold is set',
+        gt=0,
+        le=1,
+    )
+    slow_request_buffer_size: int = Field(
+        100,
+        title='Number of slow-request traces kept per worker',
+        gt=0,
+    )
+    slow_request_sample_interval: float = Field(
+        0.02,
+        title='Seconds between stack samples of traced requests',
+        gt=0,
+    )
+    shards: List[ShardSettings] = Field(
+        [],
+        title='Databases holding the users and their tasks; empty to use the main database',
+    )
+    shard_scheme: str = Field(
+        'hash',
+        title='How users are mapped to shards: "hash" (consistent hashing) or '
+        '"directory" (a shard_directory table in the main database)',
+        regex='^(hash|directory)$',
+    )
+    shard_virtual_nodes: int = Field(
+        64,
+        title='Points per shard on the consistent hash ring',
+        gt=0,
+    )
+    server: Dict[str, Any] = Field(
+        {},
+        title='Options for the production server, see tasklist.serve',
+    )
+
+    class Config:
+        # Every field can be overridden through a TASKLIST_<FIELD> variable,
+        # e.g. TASKLIST_DB_HOST or TASKLIST_DB_PASSWORD.
+        env_prefix = 'TASKLIST_'
+
+        @classmethod
+        def customise_sources(cls, init_settings, env_settings, file_secret_settings):
+            # Environment variables take precedence over the config files.
+            return env_settings, init_settings, file_secret_settings
+
+    @property
+    def credentials(self):
+        return {
+            'user': self.db_user,
+            'password': self.db_password,
+            'host': self.db_host,
+            'database': self.database,
+        }
+
+    @property
+    def shard_credentials(self):
+        return [
+            {
+                'user': shard.db_user or self.db_user,
+                'password': shard.db_password or self.db_password,
+                'host': shard.db_host,
+                'database': shard.database,
+            }
+            for shard in self.shards
+        ]
+
+
+_settings: Optional[Settings] = None
+_file_names: Dict[str, Optional[str]] = {
+    'config_file_name': None,
+    'secrets_file_name': None,
+}
+
+
+def read_settings(config_file_name: str, secrets_file_name: str):
+    with open(config_file_name, 'r') as file:
+        values = json.load(file)
+    # The secrets file may be absent when the credentials come from the
+    # environment instead.
+    if os.path.exists(secrets_file_name):
+        with open(secrets_file_name, 'r') as file:
+            secrets = json.load(file)
+        values['db_user'] = secrets['user']
+        values['db_password'] = secrets['password']
+    return Settings(**values)
+
+
+def load_settings(config_file_name: str = None, secrets_file_name: str = None):
+    global _settings
+    config_file_name = (
+        config_file_name
+        or os.environ.get('TASKLIST_CONFIG_FILE')
+        or get_config_filename()
+    )
+    secrets_file_name = (
+        secrets_file_name
+        or os.environ.get('TASKLIST_SECRETS_FILE')
+        or get_app_secrets_filename()
+    )
+    _settings = read_settings(config_file_name, secrets_file_name)
+    _file_names['config_file_name'] = config_file_name
+    _file_names['secrets_file_name'] = secrets_file_name
+    return _settings
+
+
+def reload_settings():
+    # Re-reads the files the current settings came from, e.g. after rotating
+    # the database secrets. The new settings are validated before replacing
+    # the old ones, so a broken file leaves the running settings untouched.
+    return load_settings(**_file_names)
+
+
+def get_settings():
+    if _settings is None:
+        return load_settings()
+    return _settings
@@ -0,0 +1,336 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+import bisect
+import contextvars
+import hashlib
+import threading
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+
+from .models import TaskFilter
+
+# Fan-out queries run in parallel on this pool. It is created on first use,
+# i.e. after gunicorn forks the workers.
+FAN_OUT_THREADS = 32
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FAN_OUT_THREADS)
+    return _executor
+
+
+def hash_key(data: bytes):
+    return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+
+class HashRing:
+    # Consistent hashing: each shard owns `virtual_nodes` points on a ring,
+    # and a user belongs to the first point after the hash of its UUID.
+    # Adding a shard only moves the users that land on the new points.
+    def __init__(self, shard_count: int, virtual_nodes: int):
+        points = sorted(
+            (hash_key(f'{shard}:{node}'.encode('ascii')), shard)
+            for shard in range(shard_count)
+            for node in range(virtual_nodes)
+        )
+        self.keys = [key for key, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, user_uuid: uuid.UUID):
+        index = bisect.bisect(self.keys, hash_key(user_uuid.bytes)) % len(self.keys)
+        return self.shards[index]
+
+
+@lru_cache
+def get_ring(shard_count: int, virtual_nodes: int):
+    return HashRing(shard_count, virtual_nodes)
+
+
+class ShardedDBSession:
+    # Same interface as DBSession, over several databases. Users and their
+    # tasks live on the shard of the user; user-scoped operations go to that
+    # shard alone, while global reads and lookups by task UUID fan out to
+    # every shard in parallel and merge the results. Connections are opened
+    # on first use of each shard.
+    #
+    # Moving a task or user between shards copies it to the new shard before
+    # deleting it from the old one. The two steps are separate transactions,
+    # so an interruption can leave a copy on both shards, never on neither.
+    def __init__(self, open_session, settings):
+        self.open_session = open_session
+        self.shard_credentials = settings.shard_credentials
+        self.directory_credentials = settings.credentials
+        self.scheme = settings.shard_scheme
+        self.ring = get_ring(len(settings.shards), settings.shard_virtual_nodes)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, key, credentials):
+        # Called from the fan-out threads; connections are opened outside the
+        # lock so shards connect in parallel.
+        with self.lock:
+            if key in self.sessions:
+                return self.sessions[key]
+        session = self.open_session(credentials)
+        with self.lock:
+            if key in self.sessions:
+                session.connection.close()
+            else:
+                self.sessions[key] = session
+            return self.sessions[key]
+
+    def shard(self, index):
+        return self.session(index, self.shard_credentials[index])
+
+    @property
+    def directory(self):
+        return self.session('directory', self.directory_credentials)
+
+    def close(self):
+        for session in self.sessions.values():
+            session.connection.close()
+        self.sessions = {}
+
+    @property
+    def shard_count(self):
+        return len(self.shard_credentials)
+
+    def shard_for(self, user_uuid: uuid.UUID):
+        if self.scheme == 'directory':
+            shard = self.directory.read_shards([user_uuid]).get(user_uuid)
+            if shard is not None:
+                return shard
+        return self.ring.shard_for(user_uuid)
+
+    def group_by_shard(self, user_uuids):
+        assigned = {}
+        if self.scheme == 'directory':
+            assigned = self.directory.read_shards(user_uuids)
+        groups = {}
+        for user_uuid in user_uuids:
+            shard = assigned.get(user_uuid)
+            if shard is None:
+                shard = self.ring.shard_for(user_uuid)
+            groups.setdefault(shard, []).append(user_uuid)
+        return groups
+
+    @staticmethod
+    def parallel(calls):
+        # Each call runs in a copy of the caller's context, so per-request
+        # state such as the slow-request trace follows it to the executor.
+        calls = list(calls)
+        contexts = [contextvars.copy_context() for _ in calls]
+        return list(get_executor().map(lambda context, call: context.run(call), contexts, calls))
+
+    def fan_out(self, function, shards=None):
+        shards = range(self.shard_count) if shards is None else shards
+        return self.parallel([
+            lambda index=index: function(self.shard(index))
+            for index in shards
+        ])
+
+    def find_task_shard(self, uuid_: uuid.UUID):
+        found = self.fan_out(lambda db: uuid_ in db.read_tasks_by_uuid([uuid_])[0])
+        for index, is_found in enumerate(found):
+            if is_found:
+                return index
+        raise KeyError()
+
+#task functions
+
+    def read_tasks(self, completed: bool = None, include_archived: bool = False):
+        results = {}
+        for tasks in self.fan_out(lambda db: db.read_tasks(completed, include_archived)):
+            results.update(tasks)
+        return results
+
+    def create_task(self, item):
+        return self.shard(self.shard_for(item.user_uuid)).create_task(item)
+
+    def read_task(self, uuid_: uuid.UUID):
+        found = self.read_tasks_by_uuid([uuid_])[0]
+        if uuid_ not in found:
+            raise KeyError()
+        return found[uuid_]
+
+    def read_tasks_by_uuid(self, uuids):
+        uuids = list(dict.fromkeys(uuids))
+        found = {}
+        for shard_found, _ in self.fan_out(lambda db: db.read_tasks_by_uuid(uuids)):
+            found.update(shard_found)
+        return found, [uuid_ for uuid_ in uuids if uuid_ not in found]
+
+    def replace_task(self, uuid_, item):
+        source = self.find_task_shard(uuid_)
+        target = self.shard_for(item.user_uuid)
+        if source == target:
+            self.shard(source).replace_task(uuid_, item)
+            return
+        self.shard(target).import_tasks([(uuid_, item)])
+        self.shard(source).remove_task(uuid_)
+
+    def remove_task(self, uuid_):
+        self.shard(self.find_task_shard(uuid_)).remove_task(uuid_)
+
+    def remove_all_tasks(self):
+        return sum(self.fan_out(lambda db: db.remove_all_tasks()))
+
+    def select_tasks(self, task_filter: TaskFilter):
+        results = {}
+        for tasks in self.fan_out(lambda db: db.select_tasks(task_filter), self.filter_shards(task_filter)):
+            results.update(tasks)
+        return results
+
+    def update_tasks(self, task_filter: TaskFilter, update: dict, chunk_size: int):
+        shards = self.filter_shards(task_filter)
+        if 'user_uuid' not in update:
+            return sum(self.fan_out(
+                lambda db: db.update_tasks(task_filter, update, chunk_size),
+                shards,
+            ))
+
+        # Reassigning tasks: update in place on the new user's shard, move
+        # the matching tasks found on every other shard.
+        target = self.shard_for(update['user_uuid'])
+        affected = 0
+        if target in shards:
+            affected += self.shard(target).update_tasks(task_filter, update, chunk_size)
+        for index in shards:
+            if index == target:
+                continue
+            tasks = self.shard(index).select_tasks(task_filter)
+            if not tasks:
+                continue
+            self.shard(target).import_tasks(
+                [(uuid_, task.copy(update=update)) for uuid_, task in tasks.items()],
+                chunk_size,
+            )
+            affected += self.shard(index).remove_tasks(TaskFilter(uuids=list(tasks)), chunk_size)
+        return affected
+
+    def remove_tasks(self, task_filter: TaskFilter, chunk_size: int):
+        return sum(self.fan_out(
+            lambda db: db.remove_tasks(task_filter, chunk_size),
+            self.filter_shards(task_filter),
+        ))
+
+    def filter_shards(self, task_filter: TaskFilter):
+        if task_filter.user_uuid is not None:
+            return [self.shard_for(task_filter.user_uuid)]
+        return list(range(self.shard_count))
+
+    def iter_tasks(self, chunk_size: int):
+        return chain.from_iterable(
+            self.shard(index).iter_tasks(chunk_size)
+            for index in range(self.shard_count)
+        )
+
+    def import_tasks(self, items, chunk_size: int):
+        return self.import_grouped(items, chunk_size, lambda item: item[1].user_uuid, 'import_tasks')
+
+    def reconcile_task_counts(self):
+        return sum(self.fan_out(lambda db: db.reconcile_task_counts()))
+
+    def archive_completed_tasks(self, older_than: float, batch_size: int, pause: float = 0.0):
+        return sum(self.fan_out(lambda db: db.archive_completed_tasks(older_than, batch_size, pause)))
+
+    def import_grouped(self, items, chunk_size, get_user_uuid, method):
+        # Buffers items per shard and flushes each buffer when it holds a
+        # full chunk, so every shard still gets multi-row INSERTs.
+        total = 0
+        buffers = {}
+        for item in items:
+            shard = self.shard_for(get_user_uuid(item))
+            buffer = buffers.setdefault(shard, [])
+            buffer.append(item)
+            if len(buffer) == chunk_size:
+                total += getattr(self.shard(shard), method)(buffer, chunk_size)
+                buffers[shard] = []
+        for shard, buffer in buffers.items():
+            if buffer:
+                total += getattr(self.shard(shard), method)(buffer, chunk_size)
+        return total
+
+#user functions
+
+    def read_users(self, include_counts: bool = False):
+        results = {}
+        for users in self.fan_out(lambda db: db.read_users(include_counts)):
+            results.update(users)
+        return results
+
+    def create_user(self, item):
+        uuid_ = uuid.uuid4()
+        shard = self.ring.shard_for(uuid_)
+        if self.scheme == 'directory':
+            self.directory.assign_shard(uuid_, shard)
+        self.shard(shard).import_users([(uuid_, item)])
+        return uuid_
+
+    def read_user(self, uuid_: uuid.UUID):
+        return self.shard(self.shard_for(uuid_)).read_user(uuid_)
+
+    def read_users_by_uuid(self, uuids):
+        uuids = list(dict.fromkeys(uuids))
+        found = {}
+        for shard_found, _ in self.parallel([
+                lambda shard=shard, shard_uuids=shard_uuids:
+                self.shard(shard).read_users_by_uuid(shard_uuids)
+                for shard, shard_uuids in self.group_by_shard(uuids).items()
+        ]):
+            found.update(shard_found)
+        return found, [uuid_ for uuid_ in uuids if uuid_ not in found]
+
+    def replace_user(self, uuid_, item):
+        self.shard(self.shard_for(uuid_)).replace_user(uuid_, item)
+
+    def remove_user(self, uuid_):
+        self.shard(self.shard_for(uuid_)).remove_user(uuid_)
+        if self.scheme == 'directory':
+            self.directory.remove_shard_assignment(uuid_)
+
+    def remove_all_users(self):
+        self.fan_out(lambda db: db.remove_all_users())
+
+    def iter_users(self, chunk_size: int):
+        return chain.from_iterable(
+            self.shard(index).iter_users(chunk_size)
+            for index in range(self.shard_count)
+        )
+
+    def import_users(self, items, chunk_size: int):
+        def assign_shards(items):
+            for item in items:
+                self.directory.assign_shard(item[0], self.shard_for(item[0]))
+                yield item
+
+        if self.scheme == 'directory':
+            items = assign_shards(items)
+        return self.import_grouped(items, chunk_size, lambda item: item[0], 'import_users')
+
+#rebalancing
+
+    def move_user(self, user_uuid: uuid.UUID, source: int, target: int):
+        # Copies a user and its tasks from `source` to `target`, updates the
+        # directory, then deletes them from `source` (cascading to the
+        # tasks). Returns the number of tasks moved.
+        if source == target:
+            return 0
+        source_db = self.shard(source)
+        user = source_db.read_user(user_uuid)
+        tasks = source_db.select_tasks(TaskFilter(user_uuid=user_uuid))
+
+        target_db = self.shard(target)
+        target_db.import_users([(user_uuid, user)])
+        target_db.import_tasks(list(tasks.items()))
+        if self.scheme == 'directory':
+            self.directory.assign_shard(user_uuid, target)
+        source_db.remove_user(user_uuid)
+        return len(tasks)
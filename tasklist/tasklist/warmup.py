@@ -0,0 +1,111 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring, unused-argument
+#
+# Startup warm-up. Each worker runs these steps in a background thread as
+# soon as it starts, so the first requests after a deploy do not pay for
+# loading the settings, building the models' validators and encoders,
+# opening the pool connections and reading cold InnoDB pages. /ready
+# answers 503 until every step has finished; /live only tells that the
+# process is up.
+import logging
+import threading
+import time
+
+from . import database, metrics
+from .models import Task, TaskBulkUpdate, TaskFilter, User
+from .settings import get_settings
+
+# Logged through uvicorn's logger, which the servers already configure.
+logger = logging.getLogger('uvicorn.error')
+
+_steps = {}
+_state = {'ready': False, 'error': None}
+_lock = threading.Lock()
+
+
+def load_settings_step(app):
+    # Reads and validates the config and secrets files, unless the master
+    # process already did before forking.
+    get_settings()
+
+
+def build_models_step(app):
+    for model in [Task, User, TaskFilter, TaskBulkUpdate]:
+        model.parse_obj(model.Config.schema_extra['example']).json()
+    app.openapi()
+
+
+def open_connections_step(app):
+    database.warm_up_connections(get_settings())
+
+
+def preload_step(app):
+    if not get_settings().warmup_preload:
+        return
+    with database.session_scope() as db:
+        db.read_users(include_counts=True)
+        db.read_tasks(completed=False)
+
+
+STEPS = [
+    ('settings', load_settings_step),
+    ('models', build_models_step),
+    ('connections', open_connections_step),
+    ('preload', preload_step),
+]
+
+
+def run(app):
+    # Runs every step once. Returns whether all of them succeeded.
+    reset()
+    started = time.monotonic()
+    for name, step in STEPS:
+        step_started = time.monotonic()
+        try:
+            step(app)
+        except Exception as exception:  # pylint: disable=broad-except
+            logger.exception('Warm-up step %s failed', name)
+            with _lock:
+                _state['error'] = f'{name}: {exception!r}'
+            return False
+        seconds = time.monotonic() - step_started
+        logger.info('Warm-up step %s took %.3fs', name, seconds)
+        metrics.increment('warmup_seconds', seconds, step=name)
+        with _lock:
+            _steps[name] = seconds
+    logger.info('Warm-up finished in %.3fs', time.monotonic() - started)
+    with _lock:
+        _state['ready'] = True
+    return True
+
+
+def run_until_ready(app):
+    # A database that is still starting must not leave the worker out of
+    # rotation for good, so failed warm-ups are retried.
+    while not run(app):
+        time.sleep(get_settings().warmup_retry_interval)
+
+
+def start(app):
+    thread = threading.Thread(target=run_until_ready, args=(app, ), name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def reset():
+    with _lock:
+        _steps.clear()
+        _state['ready'] = False
+        _state['error'] = None
+
+
+def is_ready():
+    return _state['ready']
+
+
+def status():
+    with _lock:
+        return {
+            'ready': _state['ready'],
+            'steps': dict(_steps),
+            'error': _state['error'],
+        }
@@ -1,16 +1,23 @@
 # pylint: disable=missing-module-docstring,missing-function-docstring
 import os.path
+import threading
+import time
+import uuid
+
+import msgpack
 
 from fastapi.testclient import TestClient
 
 from utils import utils
 
+from tasklist.database import DBSession, session_scope
+from tasklist import coalescing, metrics, profiling, warmup
 from tasklist.main import app
+from tasklist.settings import get_settings, load_settings
 
 client = TestClient(app)
 
-app.dependency_overrides[utils.get_config_filename] = \
-    utils.get_config_test_filename
+load_settings(config_file_name=utils.get_config_test_filename())
 
 
 def setup_database():
@@ -32,6 +39,24 @@ def test_read_main_returns_not_found():
     assert response.json() == {'detail': 'Not Found'}
 
 
+def test_ready_after_warm_up():
+    setup_database()
+    warmup.reset()
+
+    response = client.get('/live')
+    assert response.status_code == 200
+
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.json()['ready'] is False
+
+    assert warmup.run(app)
+
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert set(response.json()['steps']) == {'settings', 'models', 'connections', 'preload'}
+
+
 def test_read_tasks_with_no_task():
     setup_database()
     response = client.get('/task')
@@ -257,6 +282,529 @@ def test_delete_all_tasks():
     assert response.json() == {}
 
 
+def test_batch_get_tasks():
+    setup_database()
+
+    # Create a user
+    user = {"name": "giovanna"}
+    response = client.post("/user", json=user)
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # Create some tasks.
+    tasks = [
+        {'description': 'foo', 'completed': False, "user_uuid": user_uuid},
+        {'description': 'bar', 'completed': True, "user_uuid": user_uuid},
+    ]
+    uuids = []
+    for task in tasks:
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        uuids.append(response.json())
+
+    # Read them back along with a missing UUID.
+    missing_uuid = '3668e9c9-df18-4ce2-9bb2-82f907cf110c'
+    response = client.post('/task/batch-get', json=[*uuids, missing_uuid])
+    assert response.status_code == 200
+    assert response.json() == {
+        'found': dict(zip(uuids, tasks)),
+        'missing': [missing_uuid],
+    }
+
+
+def test_batch_get_invalid_task():
+    setup_database()
+
+    response = client.post('/task/batch-get', json=['invalid_uuid'])
+    assert response.status_code == 422
+
+
+def test_read_tasks_compressed():
+    setup_database()
+
+    # Create a user
+    user = {"name": "giovanna"}
+    response = client.post("/user", json=user)
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # Create enough tasks to go over the compression threshold.
+    task = {'description': 'foo', 'completed': False, "user_uuid": user_uuid}
+    uuids = []
+    for _ in range(20):
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        uuids.append(response.json())
+
+    response = client.get('/task', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert response.json() == {uuid_: task for uuid_ in uuids}
+
+    # q=0 refuses a coding.
+    response = client.get('/task', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.json() == {uuid_: task for uuid_ in uuids}
+
+    # Small responses are sent as they are.
+    response = client.get(f'/task/{uuids[0]}', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.json() == task
+
+
+def test_read_and_create_tasks_with_msgpack():
+    setup_database()
+
+    # Create a user
+    user = {"name": "giovanna"}
+    response = client.post("/user", json=user)
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # Request bodies may be MessagePack, with UUIDs as 16-byte binaries.
+    task = {'description': 'foo', 'completed': False, "user_uuid": user_uuid}
+    response = client.post(
+        '/task',
+        data=msgpack.packb({**task, 'user_uuid': uuid.UUID(user_uuid).bytes}),
+        headers={'Content-Type': 'application/msgpack', 'Accept': 'application/msgpack'},
+    )
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/msgpack'
+    uuid_ = uuid.UUID(bytes=msgpack.unpackb(response.content))
+
+    headers = {'Accept': 'application/msgpack'}
+    response = client.get('/task', headers=headers)
+    assert response.status_code == 200
+    assert 'Accept' in response.headers['Vary']
+    assert msgpack.unpackb(response.content, strict_map_key=False) == {
+        uuid_.bytes: {**task, 'user_uuid': uuid.UUID(user_uuid).bytes},
+    }
+
+    response = client.get('/task', headers={'Accept': 'application/msgpack; layout=columnar'})
+    assert response.status_code == 200
+    assert msgpack.unpackb(response.content) == {
+        'uuid': [uuid_.bytes],
+        'description': ['foo'],
+        'completed': [False],
+        'user_uuid': [uuid.UUID(user_uuid).bytes],
+    }
+
+    # JSON stays the default.
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == {str(uuid_): task}
+
+
+def test_rate_limit_task_list():
+    setup_database()
+
+    settings = get_settings()
+    # Admission is off in the test config, so other tests share no bucket.
+    old_enabled, old_api_keys = settings.admission_enabled, settings.api_keys
+    old_rate, old_burst = settings.rate_limit_rate, settings.rate_limit_burst
+    settings.admission_enabled = True
+    settings.rate_limit_rate, settings.rate_limit_burst = 0.1, 10.0
+    settings.api_keys = ['test_rate_limit_task_list', 'another_client']
+    try:
+        # Reading the whole list costs 10 tokens and drains the bucket.
+        headers = {'X-API-Key': 'test_rate_limit_task_list'}
+        response = client.get('/task', headers=headers)
+        assert response.status_code == 200
+
+        response = client.get('/task', headers=headers)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+        # Other clients have their own bucket.
+        response = client.get('/task', headers={'X-API-Key': 'another_client'})
+        assert response.status_code == 200
+
+        # Unknown keys share the bucket of the client address, so rotating
+        # them does not help.
+        client.get('/task', headers={'X-API-Key': 'rotated_1'})
+        response = client.get('/task', headers={'X-API-Key': 'rotated_2'})
+        assert response.status_code == 429
+    finally:
+        settings.rate_limit_rate, settings.rate_limit_burst = old_rate, old_burst
+        settings.admission_enabled, settings.api_keys = old_enabled, old_api_keys
+
+
+def test_request_timeout():
+    setup_database()
+
+    response = client.get('/task', headers={'X-Request-Timeout': '0'})
+    assert response.status_code == 504
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'request_timeouts_total{route="GET /task"}' in response.text
+
+
+def test_profile_and_slow_requests():
+    setup_database()
+
+    settings = get_settings()
+    old_keys, old_threshold = settings.admin_api_keys, settings.slow_request_threshold
+    settings.admin_api_keys, settings.slow_request_threshold = ['test_admin'], 0.0
+    profiling.clear_slow_requests()
+    try:
+        response = client.get('/debug/slow')
+        assert response.status_code == 403
+
+        response = client.get('/task')
+        assert response.status_code == 200
+
+        headers = {'X-API-Key': 'test_admin'}
+        response = client.get('/debug/slow', headers=headers)
+        assert response.status_code == 200
+        latest = response.json()[0]
+        assert (latest['method'], latest['path'], latest['status']) == ('GET', '/task', 200)
+        assert any('FROM tasks' in query['sql'] for query in latest['queries'])
+
+        response = client.get('/debug/profile?seconds=0.2', headers=headers)
+        assert response.status_code == 200
+        lines = response.text.splitlines()
+        assert lines
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    finally:
+        settings.admin_api_keys, settings.slow_request_threshold = old_keys, old_threshold
+
+
+def test_coalesce_identical_reads():
+    release = threading.Event()
+    calls = []
+
+    def read():
+        calls.append(None)
+        release.wait(5)
+        return len(calls)
+
+    key = ('test_coalesce_identical_reads', )
+    hits = metrics.get('coalesced_reads_total', read=key[0])
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(coalescing.do(key, ['tasks'], read)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    while metrics.get('coalesced_reads_total', read=key[0]) < hits + 4:
+        time.sleep(0.01)
+
+    # A write detaches the flight: the next read runs its own query.
+    coalescing.invalidate(['tasks'])
+    late = threading.Thread(target=lambda: results.append(coalescing.do(key, ['tasks'], read)))
+    late.start()
+    while len(calls) < 2:
+        time.sleep(0.01)
+
+    release.set()
+    for thread in [*threads, late]:
+        thread.join()
+    assert len(calls) == 2
+    assert len(results) == 6
+
+
+def test_read_after_write_is_not_coalesced(monkeypatch):
+    setup_database()
+
+    response = client.post('/user', json={'name': 'giovanna'})
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # The first read fetches the user, then holds its flight open.
+    read_user = DBSession.read_user
+    started, release = threading.Event(), threading.Event()
+
+    def held_read_user(db, uuid_):
+        user = read_user(db, uuid_)
+        if not started.is_set():
+            started.set()
+            release.wait(5)
+        return user
+
+    monkeypatch.setattr(DBSession, 'read_user', held_read_user)
+    held = []
+    leader = threading.Thread(target=lambda: held.append(client.get(f'/user/{user_uuid}')))
+    leader.start()
+    assert started.wait(5)
+
+    try:
+        # The write detaches the held flight, so the next read does not
+        # join it and sees the new name.
+        response = client.put(f'/user/{user_uuid}', json={'name': 'mayra'})
+        assert response.status_code == 200
+
+        response = client.get(f'/user/{user_uuid}')
+        assert response.status_code == 200
+        assert response.json() == {'name': 'mayra'}
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+    finally:
+        release.set()
+        leader.join()
+    assert held[0].json() == {'name': 'giovanna'}
+
+
+def test_deleting_users_invalidates_task_reads(monkeypatch):
+    setup_database()
+
+    response = client.post('/user', json={'name': 'giovanna'})
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # The user's tasks go with it through ON DELETE CASCADE.
+    invalidated = set()
+    monkeypatch.setattr(coalescing, 'invalidate', invalidated.update)
+    response = client.delete(f'/user/{user_uuid}')
+    assert response.status_code == 200
+    assert {'users', 'tasks', 'tasks_archive'} <= invalidated
+
+
+def test_export_and_import_tasks():
+    setup_database()
+
+    # Create a user
+    user = {"name": "giovanna"}
+    response = client.post("/user", json=user)
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # Create some tasks.
+    tasks = [
+        {'description': 'foo', 'completed': False, "user_uuid": user_uuid},
+        {'description': 'bar, "quoted"', 'completed': True, "user_uuid": user_uuid},
+        {'description': 'C:\\temp\\new', 'completed': False, "user_uuid": user_uuid},
+        {'description': '', 'completed': False, "user_uuid": user_uuid},
+    ]
+    uuids = []
+    for task in tasks:
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        uuids.append(response.json())
+    expected = dict(zip(uuids, tasks))
+
+    for data_format in ['ndjson', 'csv', 'msgpack']:
+        # Export, wipe the table and import the file back.
+        response = client.get(f'/task/export?format={data_format}')
+        assert response.status_code == 200
+        exported = response.content
+
+        response = client.delete('/task')
+        assert response.status_code == 200
+
+        response = client.post(f'/task/import?format={data_format}', data=exported)
+        assert response.status_code == 200
+        assert response.json()['rows'] == len(tasks)
+
+        response = client.get('/task')
+        assert response.status_code == 200
+        assert response.json() == expected
+
+    # Imported tasks count towards their user.
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[user_uuid]['task_count'] == len(tasks)
+
+
+def test_import_msgpack_stream():
+    setup_database()
+
+    # Create a user
+    user = {"name": "giovanna"}
+    response = client.post("/user", json=user)
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    # One map per task, UUIDs as 16-byte binaries, sent with the media
+    # type of the format.
+    tasks = {
+        str(uuid.uuid4()): {'description': description, 'completed': completed, 'user_uuid': user_uuid}
+        for description, completed in [('foo', False), ('bar', True), ('baz', False)]
+    }
+    stream = b''.join(
+        msgpack.packb({
+            **task,
+            'uuid': uuid.UUID(uuid_).bytes,
+            'user_uuid': uuid.UUID(task['user_uuid']).bytes,
+        })
+        for uuid_, task in tasks.items()
+    )
+    response = client.post(
+        '/task/import?format=msgpack',
+        data=stream,
+        headers={'Content-Type': 'application/msgpack'},
+    )
+    assert response.status_code == 200
+    assert response.json()['rows'] == len(tasks)
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == tasks
+
+
+def test_import_invalid_tasks():
+    setup_database()
+
+    response = client.post('/task/import?format=ndjson', data='{"completed": true}\n')
+    assert response.status_code == 422
+
+    response = client.post('/task/import?format=ndjson', data='{"uuid": 5, "completed": true}\n')
+    assert response.status_code == 422
+
+    response = client.post('/task/import?format=ndjson', data='[1, 2]\n')
+    assert response.status_code == 422
+
+    data = 'uuid,description,completed,user_uuid\r\n,foo,0,3668e9c9-df18-4ce2-9bb2-82f907cf110c,extra\r\n'
+    response = client.post('/task/import?format=csv', data=data)
+    assert response.status_code == 422
+
+
+def test_alter_and_delete_tasks_by_filter():
+    setup_database()
+
+    # Create two users.
+    user_uuids = []
+    for user in [{'name': 'giovanna'}, {'name': 'mayra'}]:
+        response = client.post('/user', json=user)
+        assert response.status_code == 200
+        user_uuids.append(response.json())
+
+    # Give each user two open tasks.
+    task_uuids = {}
+    for user_uuid in user_uuids:
+        for description in ['foo', 'bar']:
+            task = {'description': description, 'completed': False, 'user_uuid': user_uuid}
+            response = client.post('/task', json=task)
+            assert response.status_code == 200
+            task_uuids[response.json()] = task
+
+    # Complete all tasks of the first user.
+    bulk_update = {
+        'filter': {'user_uuid': user_uuids[0], 'completed': False},
+        'update': {'completed': True},
+    }
+    response = client.patch('/task', json=bulk_update)
+    assert response.status_code == 200
+    assert response.json() == {'affected': 2}
+
+    response = client.get('/task?completed=true')
+    assert response.status_code == 200
+    assert {task['user_uuid'] for task in response.json().values()} == {user_uuids[0]}
+    assert len(response.json()) == 2
+
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[user_uuids[0]]['open_task_count'] == 0
+    assert response.json()[user_uuids[1]]['open_task_count'] == 2
+
+    # Rename an explicit list of tasks.
+    some_uuids = list(task_uuids)[1:3]
+    bulk_update = {'filter': {'uuids': some_uuids}, 'update': {'description': 'baz'}}
+    response = client.patch('/task', json=bulk_update)
+    assert response.status_code == 200
+    assert response.json() == {'affected': 2}
+
+    response = client.post('/task/batch-get', json=some_uuids)
+    assert response.status_code == 200
+    assert {task['description'] for task in response.json()['found'].values()} == {'baz'}
+
+    # Updates without fields are rejected.
+    response = client.patch('/task', json={'filter': {}, 'update': {}})
+    assert response.status_code == 422
+
+    # So are null fields, and empty filters unless all_tasks is set.
+    response = client.patch('/task', json={'filter': {'completed': True}, 'update': {'user_uuid': None}})
+    assert response.status_code == 422
+
+    response = client.patch('/task', json={'filter': {}, 'update': {'description': 'baz'}})
+    assert response.status_code == 422
+
+    response = client.patch('/task', json={'filter': {}, 'update': {'description': 'baz'}, 'all_tasks': True})
+    assert response.status_code == 200
+    assert response.json() == {'affected': 4}
+
+    # Empty filters do not delete everything by accident.
+    for task_filter in [{}, {'user_uuid': None}]:
+        response = client.request('DELETE', '/task', json=task_filter)
+        assert response.status_code == 422
+
+    # Delete the completed tasks.
+    response = client.request('DELETE', '/task', json={'completed': True})
+    assert response.status_code == 200
+    assert response.json() == {'affected': 2}
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert {task['user_uuid'] for task in response.json().values()} == {user_uuids[1]}
+
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[user_uuids[0]]['task_count'] == 0
+    assert response.json()[user_uuids[1]]['task_count'] == 2
+
+
+def test_archive_completed_tasks():
+    setup_database()
+
+    response = client.post('/user', json={'name': 'giovanna'})
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    tasks = {}
+    for description, completed in [('foo', True), ('bar', False), ('baz', True)]:
+        task = {'description': description, 'completed': completed, 'user_uuid': user_uuid}
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        tasks[response.json()] = task
+
+    with session_scope(pooled=False) as db:
+        assert db.archive_completed_tasks(0, 1) == 2
+        assert db.archive_completed_tasks(0, 1) == 0
+
+    # Archived tasks leave the list, but can still be read one by one.
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert {task['description'] for task in response.json().values()} == {'bar'}
+
+    response = client.get('/task?include_archived=true')
+    assert response.status_code == 200
+    assert response.json() == tasks
+
+    for uuid_, task in tasks.items():
+        response = client.get(f'/task/{uuid_}')
+        assert response.status_code == 200
+        assert response.json() == task
+
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[user_uuid]['task_count'] == 3
+    assert response.json()[user_uuid]['open_task_count'] == 1
+
+    # Writing an archived task brings it back to the hot table.
+    foo_uuid = next(uuid_ for uuid_, task in tasks.items() if task['description'] == 'foo')
+    response = client.patch(f'/task/{foo_uuid}', json={'completed': False, 'user_uuid': user_uuid})
+    assert response.status_code == 200
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert {task['description'] for task in response.json().values()} == {'foo', 'bar'}
+
+    response = client.request('DELETE', '/task', json={'user_uuid': user_uuid})
+    assert response.status_code == 200
+    assert response.json() == {'affected': 3}
+
+    response = client.get('/task?include_archived=true')
+    assert response.status_code == 200
+    assert response.json() == {}
+
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[user_uuid]['task_count'] == 0
+
+
 #user tests
 
 def test_read_users_with_no_user():
@@ -412,3 +960,107 @@ def test_delete_all_users():
     response = client.get('/user')
     assert response.status_code == 200
     assert response.json() == {}
+
+
+def test_batch_get_users():
+    setup_database()
+
+    # Create some users.
+    users = [{'name': 'giovanna'}, {'name': 'mayra'}]
+    uuids = []
+    for user in users:
+        response = client.post('/user', json=user)
+        assert response.status_code == 200
+        uuids.append(response.json())
+
+    # Read them back along with a missing UUID.
+    missing_uuid = '3668e9c9-df18-4ce2-9bb2-82f907cf110c'
+    response = client.post('/user/batch-get', json=[missing_uuid, *uuids])
+    assert response.status_code == 200
+    assert response.json() == {
+        'found': dict(zip(uuids, users)),
+        'missing': [missing_uuid],
+    }
+
+
+def test_read_users_with_task_counts():
+    setup_database()
+
+    # Create two users.
+    user_uuids = []
+    for user in [{'name': 'giovanna'}, {'name': 'mayra'}]:
+        response = client.post('/user', json=user)
+        assert response.status_code == 200
+        user_uuids.append(response.json())
+
+    # Give the first user two tasks, one of them completed.
+    task_uuids = []
+    for completed in [False, True]:
+        task = {'description': 'foo', 'completed': completed, 'user_uuid': user_uuids[0]}
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        task_uuids.append(response.json())
+
+    def get_counts():
+        response = client.get('/user?include_counts=true')
+        assert response.status_code == 200
+        return {
+            uuid_: (user['task_count'], user['open_task_count'])
+            for uuid_, user in response.json().items()
+        }
+
+    assert get_counts() == {user_uuids[0]: (2, 1), user_uuids[1]: (0, 0)}
+
+    # Move the open task to the second user.
+    task = {'description': 'foo', 'completed': False, 'user_uuid': user_uuids[1]}
+    response = client.put(f'/task/{task_uuids[0]}', json=task)
+    assert response.status_code == 200
+    assert get_counts() == {user_uuids[0]: (1, 0), user_uuids[1]: (1, 1)}
+
+    # Complete it.
+    response = client.patch(f'/task/{task_uuids[0]}', json={'completed': True, 'user_uuid': user_uuids[1]})
+    assert response.status_code == 200
+    assert get_counts() == {user_uuids[0]: (1, 0), user_uuids[1]: (1, 0)}
+
+    # Delete a task, then all of them.
+    response = client.delete(f'/task/{task_uuids[1]}')
+    assert response.status_code == 200
+    assert get_counts() == {user_uuids[0]: (0, 0), user_uuids[1]: (1, 0)}
+
+    response = client.delete('/task')
+    assert response.status_code == 200
+    assert get_counts() == {user_uuids[0]: (0, 0), user_uuids[1]: (0, 0)}
+
+    # Counts are not included unless asked for.
+    response = client.get('/user')
+    assert response.status_code == 200
+    assert response.json() == {
+        user_uuids[0]: {'name': 'giovanna'},
+        user_uuids[1]: {'name': 'mayra'},
+    }
+
+
+def test_export_and_import_users():
+    setup_database()
+
+    users = [{'name': 'giovanna'}, {'name': 'mayra'}]
+    uuids = []
+    for user in users:
+        response = client.post('/user', json=user)
+        assert response.status_code == 200
+        uuids.append(response.json())
+
+    response = client.get('/user/export?format=csv')
+    assert response.status_code == 200
+    exported = response.content
+
+    response = client.delete('/user')
+    assert response.status_code == 200
+
+    response = client.post('/user/import?format=csv', data=exported)
+    assert response.status_code == 200
+    assert response.json()['rows'] == len(users)
+
+    response = client.get('/user')
+    assert response.status_code == 200
+    assert response.json() == dict(zip(uuids, users))
@@ -0,0 +1,131 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+import json
+import os.path
+
+import mysql.connector as cnt
+
+from fastapi.testclient import TestClient
+
+from utils import utils
+from utils.online_migration import OnlineMigration
+
+from tasklist.main import app
+from tasklist.settings import load_settings
+
+client = TestClient(app)
+
+load_settings(config_file_name=utils.get_config_test_filename())
+
+
+def setup_database():
+    scripts_dir = os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        'database',
+        'migrations',
+    )
+    config_file_name = utils.get_config_test_filename()
+    secrets_file_name = utils.get_admin_secrets_filename()
+    utils.run_all_scripts(scripts_dir, config_file_name, secrets_file_name)
+
+
+def connect():
+    with open(utils.get_config_test_filename(), 'r') as file:
+        config = json.load(file)
+    with open(utils.get_admin_secrets_filename(), 'r') as file:
+        secrets = json.load(file)
+    return cnt.connect(
+        **utils.get_databases(config)[0],
+        user=secrets['user'],
+        password=secrets['password'],
+    )
+
+
+def query(connection, sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    connection.commit()
+    return rows
+
+
+def test_copy_resumes_and_keeps_concurrent_writes():
+    setup_database()
+
+    response = client.post('/user', json={'name': 'giovanna'})
+    assert response.status_code == 200
+    user_uuid = response.json()
+
+    tasks = {}
+    for i in range(5):
+        task = {'description': f'task{i}', 'completed': False, 'user_uuid': user_uuid}
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        tasks[response.json()] = task
+
+    # Adding an index cannot be INSTANT; forbid INPLACE to force a copy.
+    alter = 'ADD INDEX tasks_description (description(100))'
+    connection = connect()
+    try:
+        migration = OnlineMigration(
+            connection, 'tasks', alter, chunk_size=2, allow_inplace=False, report=lambda _: None,
+        )
+        assert migration.read_state() is None
+        assert not migration.try_alter('INSTANT')
+        migration.start_copy()
+        assert migration.copy_chunk()
+    finally:
+        connection.close()
+
+    # Writes during the copy reach the shadow table through the triggers.
+    task = {'description': 'late', 'completed': True, 'user_uuid': user_uuid}
+    response = client.post('/task', json=task)
+    assert response.status_code == 200
+    tasks[response.json()] = task
+
+    first, second = list(tasks)[:2]
+    response = client.delete(f'/task/{first}')
+    assert response.status_code == 200
+    del tasks[first]
+
+    response = client.patch(f'/task/{second}', json={'completed': True, 'user_uuid': user_uuid})
+    assert response.status_code == 200
+    tasks[second]['completed'] = True
+
+    # A new run picks up where the interrupted one stopped.
+    connection = connect()
+    try:
+        OnlineMigration(
+            connection, 'tasks', alter, chunk_size=2, allow_inplace=False, report=lambda _: None,
+        ).run()
+
+        assert query(connection, "SHOW INDEX FROM tasks WHERE Key_name = 'tasks_description'")
+        assert not query(connection, "SHOW TRIGGERS LIKE 'tasks'")
+        assert not query(connection, "SHOW TABLES LIKE '\\_tasks\\_%'")
+        assert not query(connection, 'SELECT * FROM _online_migrations')
+    finally:
+        connection.close()
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == tasks
+
+    # The foreign key came along: deleting the user deletes the tasks.
+    response = client.delete(f'/user/{user_uuid}')
+    assert response.status_code == 200
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == {}
+
+
+def test_instant_alter_skips_the_copy():
+    setup_database()
+
+    messages = []
+    connection = connect()
+    try:
+        OnlineMigration(connection, 'tasks', 'ADD priority INT NOT NULL DEFAULT 0', report=messages.append).run()
+        assert query(connection, "SHOW COLUMNS FROM tasks LIKE 'priority'")
+    finally:
+        connection.close()
+    assert any('ALGORITHM=INSTANT' in message for message in messages)
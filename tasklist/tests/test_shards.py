@@ -0,0 +1,167 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring,redefined-outer-name
+import os.path
+import uuid
+
+import pytest
+
+from fastapi.testclient import TestClient
+
+from utils import utils
+
+from tasklist.database import session_scope
+from tasklist.main import app
+from tasklist.settings import load_settings
+
+client = TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def shard_settings():
+    settings = load_settings(config_file_name=utils.get_config_test_shards_filename())
+    yield settings
+    load_settings(config_file_name=utils.get_config_test_filename())
+
+
+def setup_database():
+    scripts_dir = os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        'database',
+        'migrations',
+    )
+    config_file_name = utils.get_config_test_shards_filename()
+    secrets_file_name = utils.get_admin_secrets_filename()
+    utils.run_all_scripts(scripts_dir, config_file_name, secrets_file_name)
+
+
+def create_users_with_tasks(n_users):
+    user_uuids = []
+    tasks = {}
+    for i in range(n_users):
+        response = client.post('/user', json={'name': f'user{i}'})
+        assert response.status_code == 200
+        user_uuid = response.json()
+        user_uuids.append(user_uuid)
+
+        task = {'description': f'task{i}', 'completed': i % 2 == 0, 'user_uuid': user_uuid}
+        response = client.post('/task', json=task)
+        assert response.status_code == 200
+        tasks[response.json()] = task
+    return user_uuids, tasks
+
+
+def test_users_spread_across_shards():
+    setup_database()
+    user_uuids, tasks = create_users_with_tasks(12)
+
+    with session_scope() as db:
+        shards = {db.shard_for(uuid.UUID(user_uuid)) for user_uuid in user_uuids}
+        users_per_shard = db.fan_out(lambda shard_db: len(shard_db.read_users()))
+    assert len(shards) > 1
+    assert sum(users_per_shard) == len(user_uuids)
+
+    # Global reads merge every shard.
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == tasks
+
+    response = client.get('/task?completed=true')
+    assert response.status_code == 200
+    assert response.json() == {
+        uuid_: task for uuid_, task in tasks.items() if task['completed']
+    }
+
+    # Point reads find tasks and users wherever they are.
+    for uuid_, task in tasks.items():
+        response = client.get(f'/task/{uuid_}')
+        assert response.status_code == 200
+        assert response.json() == task
+
+    response = client.post('/user/batch-get', json=user_uuids)
+    assert response.status_code == 200
+    assert response.json()['missing'] == []
+
+
+def test_reassign_task_across_shards():
+    setup_database()
+    user_uuids, tasks = create_users_with_tasks(12)
+
+    with session_scope() as db:
+        shard_of = {user_uuid: db.shard_for(uuid.UUID(user_uuid)) for user_uuid in user_uuids}
+    source_user = user_uuids[0]
+    target_user = next(
+        user_uuid for user_uuid in user_uuids
+        if shard_of[user_uuid] != shard_of[source_user]
+    )
+    task_uuid = next(uuid_ for uuid_, task in tasks.items() if task['user_uuid'] == source_user)
+
+    # Moving the task to a user on another shard moves the row.
+    new_task = {**tasks[task_uuid], 'user_uuid': target_user}
+    response = client.put(f'/task/{task_uuid}', json=new_task)
+    assert response.status_code == 200
+
+    response = client.get(f'/task/{task_uuid}')
+    assert response.status_code == 200
+    assert response.json() == new_task
+
+    response = client.get('/user?include_counts=true')
+    assert response.status_code == 200
+    assert response.json()[source_user]['task_count'] == 0
+    assert response.json()[target_user]['task_count'] == 2
+
+    # Deleting it works on its new shard.
+    response = client.delete(f'/task/{task_uuid}')
+    assert response.status_code == 200
+    response = client.get(f'/task/{task_uuid}')
+    assert response.status_code == 404
+
+
+def test_move_user_between_shards():
+    setup_database()
+    user_uuids, tasks = create_users_with_tasks(3)
+    user_uuid = uuid.UUID(user_uuids[0])
+
+    with session_scope() as db:
+        source = db.shard_for(user_uuid)
+        target = (source + 1) % db.shard_count
+        assert db.move_user(user_uuid, source, target) == 1
+
+        assert user_uuid not in db.shard(source).read_users()
+        assert user_uuid in db.shard(target).read_users()
+
+    # Without a directory the hash ring still points at the old shard, and
+    # rebalancing moves the user back.
+    with session_scope() as db:
+        assert db.move_user(user_uuid, target, db.ring.shard_for(user_uuid)) == 1
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == tasks
+
+
+def test_directory_scheme(shard_settings):
+    setup_database()
+    shard_settings.shard_scheme = 'directory'
+
+    user_uuids, tasks = create_users_with_tasks(3)
+    user_uuid = uuid.UUID(user_uuids[0])
+
+    with session_scope() as db:
+        source = db.shard_for(user_uuid)
+        target = (source + 1) % db.shard_count
+        db.move_user(user_uuid, source, target)
+        assert db.shard_for(user_uuid) == target
+
+    # The API follows the directory.
+    response = client.get(f'/user/{user_uuid}')
+    assert response.status_code == 200
+    assert response.json() == {'name': 'user0'}
+
+    task = {'description': 'new', 'completed': False, 'user_uuid': str(user_uuid)}
+    response = client.post('/task', json=task)
+    assert response.status_code == 200
+    tasks[response.json()] = task
+
+    response = client.get('/task')
+    assert response.status_code == 200
+    assert response.json() == tasks
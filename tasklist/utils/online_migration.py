@@ -0,0 +1,474 @@
+# pylint:disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+# pylint:disable=too-many-instance-attributes, too-many-arguments
+#
+# Online schema migrations: alter a table while the service keeps reading
+# and writing it.
+#
+# The ALTER is first tried with ALGORITHM=INSTANT, then with
+# ALGORITHM=INPLACE, LOCK=NONE; MySQL refuses both right away when they
+# are not possible. Otherwise the table is rebuilt by copy:
+#
+#   1. an empty shadow table `_<table>_new` is created like the table,
+#      with the same foreign keys, and altered;
+#   2. triggers on the table replay every insert, update and delete on
+#      the shadow table;
+#   3. existing rows are copied in primary key order, one chunk per
+#      transaction, pausing while the server or its replicas are loaded;
+#   4. RENAME TABLE swaps both tables atomically, and the triggers and
+#      the old table are dropped.
+#
+# The copy position is saved in `_online_migrations` with every chunk, so
+# an interrupted migration resumes where it stopped when run again.
+#
+# Limitations: the table needs a single-column integer or binary primary
+# key, which the ALTER must keep; columns are copied by name, so renamed
+# columns are not; tables referenced by foreign keys (e.g. `users`) cannot
+# be copied, since the references would follow the old table on rename;
+# the shadow's foreign keys get generated names, so the ALTER cannot refer
+# to existing foreign keys by name.
+import re
+import time
+
+from mysql.connector.errors import DatabaseError
+
+ER_ALTER_OPERATION_NOT_SUPPORTED = 1845
+ER_ALTER_OPERATION_NOT_SUPPORTED_REASON = 1846
+ER_LOCK_WAIT_TIMEOUT = 1205
+
+STATE_TABLE = '_online_migrations'
+KEY_TYPES = {
+    'tinyint', 'smallint', 'mediumint', 'int', 'bigint', 'binary', 'varbinary',
+}
+
+# Seconds between checks while throttled, and between progress reports.
+THROTTLE_WAIT = 1.0
+REPORT_INTERVAL = 5.0
+
+# The final RENAME waits at most this long for running transactions on the
+# table, so it never queues the service's queries behind it for long.
+CUT_OVER_LOCK_WAIT = 5
+CUT_OVER_ATTEMPTS = 10
+
+
+class OnlineMigration:
+    def __init__(
+            self,
+            connection,
+            table: str,
+            alter: str,
+            chunk_size: int = 1000,
+            pause: float = 0.0,
+            max_threads_running: int = None,
+            replicas=(),
+            max_lag: float = None,
+            allow_inplace: bool = True,
+            keep_old: bool = False,
+            report=print,
+    ):
+        if not re.fullmatch(r'\w+', table):
+            raise ValueError(f'Invalid table name: {table}')
+        self.connection = connection
+        self.table = table
+        self.alter = alter.strip().rstrip(';')
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.max_threads_running = max_threads_running
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.allow_inplace = allow_inplace
+        self.keep_old = keep_old
+        self.report = report
+        self.shadow = f'_{table}_new'
+        self.old = f'_{table}_old'
+        self.triggers = {event: f'_{table}_online_{event.lower()}' for event in ['INSERT', 'UPDATE', 'DELETE']}
+        self.key = None
+        self.columns = None
+        self.last_key = None
+        self.rows_copied = 0
+        self.progress = None
+
+    def execute(self, query, params=()):
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, params)
+            if cursor.with_rows:
+                return cursor.fetchall()
+            return cursor.rowcount
+
+    def run(self):
+        state = self.read_state()
+        if state is None:
+            for algorithm in ['INSTANT', 'INPLACE'] if self.allow_inplace else ['INSTANT']:
+                if self.try_alter(algorithm):
+                    return
+            self.start_copy()
+        elif not self.table_exists(self.shadow) and self.table_exists(self.old):
+            # Interrupted right after the rename.
+            self.check_state(state)
+            self.finish()
+            return
+        else:
+            self.resume(state)
+        while self.copy_chunk():
+            pass
+        self.cut_over()
+
+    def try_alter(self, algorithm):
+        lock = '' if algorithm == 'INSTANT' else ', LOCK=NONE'
+        started = time.monotonic()
+        try:
+            self.execute(f'ALTER TABLE `{self.table}` {self.alter}, ALGORITHM={algorithm}{lock}')
+        except DatabaseError as exception:
+            if exception.errno in (ER_ALTER_OPERATION_NOT_SUPPORTED, ER_ALTER_OPERATION_NOT_SUPPORTED_REASON):
+                self.report(f'{self.table}: ALGORITHM={algorithm} not possible: {exception.msg}')
+                return False
+            raise
+        self.report(f'{self.table}: altered with ALGORITHM={algorithm} in {time.monotonic() - started:.1f}s')
+        return True
+
+    #state
+
+    def read_state(self):
+        self.execute(f'''
+            CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+                table_name VARCHAR(64) PRIMARY KEY,
+                alter_sql TEXT NOT NULL,
+                last_key VARBINARY(255),
+                rows_copied BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+        ''')
+        rows = self.execute(
+            f'SELECT alter_sql, last_key, rows_copied FROM {STATE_TABLE} WHERE table_name = %s',
+            (self.table, ),
+        )
+        self.connection.commit()
+        return rows[0] if rows else None
+
+    def check_state(self, state):
+        if state[0] != self.alter:
+            raise RuntimeError(
+                f'{self.table}: another online migration is in progress ({state[0]}); '
+                'run it to completion or abort it first'
+            )
+
+    def resume(self, state):
+        self.check_state(state)
+        _, last_key, rows_copied = state
+        if not self.table_exists(self.shadow):
+            raise RuntimeError(f'{self.table}: the shadow table {self.shadow} is gone; abort and start over')
+        self.load_columns()
+        self.last_key = self.decode_key(last_key)
+        self.rows_copied = rows_copied
+        self.report(f'{self.table}: resuming the copy after {rows_copied} rows')
+
+    def save_state(self):
+        self.execute(
+            f'UPDATE {STATE_TABLE} SET last_key = %s, rows_copied = %s WHERE table_name = %s',
+            (self.encode_key(self.last_key), self.rows_copied, self.table),
+        )
+
+    def encode_key(self, key):
+        if key is None or isinstance(key, (bytes, bytearray)):
+            return key
+        return str(key).encode('ascii')
+
+    def decode_key(self, key):
+        if key is None or self.key[1] in ('binary', 'varbinary'):
+            return key
+        return int(key)
+
+    #copy
+
+    def start_copy(self):
+        referencing = self.execute(
+            '''
+            SELECT DISTINCT TABLE_NAME
+            FROM information_schema.KEY_COLUMN_USAGE
+            WHERE REFERENCED_TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME = %s
+            ''',
+            (self.table, ),
+        )
+        if referencing:
+            names = ', '.join(row[0] for row in referencing)
+            raise RuntimeError(f'{self.table}: cannot copy a table referenced by foreign keys from {names}')
+
+        self.execute(f'DROP TABLE IF EXISTS `{self.shadow}`, `{self.old}`')
+        self.execute(f'CREATE TABLE `{self.shadow}` LIKE `{self.table}`')
+        for foreign_key in self.foreign_keys():
+            self.execute(f'ALTER TABLE `{self.shadow}` ADD {foreign_key}')
+        self.execute(f'ALTER TABLE `{self.shadow}` {self.alter}')
+        self.load_columns()
+        self.create_triggers()
+        self.execute(
+            f'REPLACE INTO {STATE_TABLE} (table_name, alter_sql) VALUES (%s, %s)',
+            (self.table, self.alter),
+        )
+        self.connection.commit()
+        self.report(f'{self.table}: copying to {self.shadow}')
+
+    def foreign_keys(self):
+        rows = self.execute(
+            '''
+            SELECT k.CONSTRAINT_NAME, k.COLUMN_NAME, k.REFERENCED_TABLE_NAME,
+                k.REFERENCED_COLUMN_NAME, r.UPDATE_RULE, r.DELETE_RULE
+            FROM information_schema.KEY_COLUMN_USAGE k
+            JOIN information_schema.REFERENTIAL_CONSTRAINTS r
+                ON r.CONSTRAINT_SCHEMA = k.CONSTRAINT_SCHEMA
+                AND r.CONSTRAINT_NAME = k.CONSTRAINT_NAME
+            WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = %s
+                AND k.REFERENCED_TABLE_NAME IS NOT NULL
+            ORDER BY k.CONSTRAINT_NAME, k.ORDINAL_POSITION
+            ''',
+            (self.table, ),
+        )
+        constraints = {}
+        for name, column, referenced_table, referenced_column, update_rule, delete_rule in rows:
+            constraint = constraints.setdefault(name, ([], referenced_table, [], update_rule, delete_rule))
+            constraint[0].append(f'`{column}`')
+            constraint[2].append(f'`{referenced_column}`')
+        # Left unnamed: MySQL generates `<table>_ibfk_<n>` names, which
+        # follow the tables through the final rename.
+        return [
+            f'FOREIGN KEY ({", ".join(columns)}) REFERENCES `{referenced_table}` '
+            f'({", ".join(referenced_columns)}) ON UPDATE {update_rule} ON DELETE {delete_rule}'
+            for columns, referenced_table, referenced_columns, update_rule, delete_rule in constraints.values()
+        ]
+
+    def load_columns(self):
+        keys = {
+            table: self.execute(
+                '''
+                SELECT k.COLUMN_NAME, c.DATA_TYPE
+                FROM information_schema.KEY_COLUMN_USAGE k
+                JOIN information_schema.COLUMNS c
+                    ON c.TABLE_SCHEMA = k.TABLE_SCHEMA
+                    AND c.TABLE_NAME = k.TABLE_NAME
+                    AND c.COLUMN_NAME = k.COLUMN_NAME
+                WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = %s
+                    AND k.CONSTRAINT_NAME = 'PRIMARY'
+                ''',
+                (table, ),
+            )
+            for table in [self.table, self.shadow]
+        }
+        key = keys[self.table]
+        if len(key) != 1 or key[0][1] not in KEY_TYPES:
+            raise RuntimeError(f'{self.table}: online copy needs a single-column integer or binary primary key')
+        if keys[self.shadow] != key:
+            raise RuntimeError(f'{self.table}: the ALTER must keep the primary key')
+        self.key = key[0]
+
+        columns = {
+            table: [
+                row[0] for row in self.execute(
+                    '''
+                    SELECT COLUMN_NAME
+                    FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                        AND EXTRA NOT LIKE %s
+                    ORDER BY ORDINAL_POSITION
+                    ''',
+                    (table, '%GENERATED%'),
+                )
+            ]
+            for table in [self.table, self.shadow]
+        }
+        self.columns = [column for column in columns[self.table] if column in columns[self.shadow]]
+
+    def create_triggers(self):
+        names = ', '.join(f'`{column}`' for column in self.columns)
+        values = ', '.join(f'NEW.`{column}`' for column in self.columns)
+        key = f'`{self.key[0]}`'
+        bodies = {
+            'INSERT': f'REPLACE INTO `{self.shadow}` ({names}) VALUES ({values})',
+            'UPDATE': f'''
+                BEGIN
+                    DELETE IGNORE FROM `{self.shadow}`
+                    WHERE {key} <=> OLD.{key} AND NOT (OLD.{key} <=> NEW.{key});
+                    REPLACE INTO `{self.shadow}` ({names}) VALUES ({values});
+                END
+            ''',
+            'DELETE': f'DELETE IGNORE FROM `{self.shadow}` WHERE {key} <=> OLD.{key}',
+        }
+        self.drop_triggers()
+        for event, body in bodies.items():
+            self.execute(
+                f'CREATE TRIGGER `{self.triggers[event]}` AFTER {event} ON `{self.table}` '
+                f'FOR EACH ROW {body}'
+            )
+
+    def drop_triggers(self):
+        for trigger in self.triggers.values():
+            self.execute(f'DROP TRIGGER IF EXISTS `{trigger}`')
+
+    def copy_chunk(self):
+        # Copies the next chunk of rows and saves the position in the same
+        # transaction. Rows the triggers already wrote are newer than the
+        # copy and are kept (INSERT IGNORE). Returns False when done.
+        self.throttle()
+        key = f'`{self.key[0]}`'
+        after = '' if self.last_key is None else f'WHERE {key} > %s'
+        after_params = () if self.last_key is None else (self.last_key, )
+        rows = self.execute(
+            f'SELECT {key} FROM `{self.table}` {after} ORDER BY {key} LIMIT {int(self.chunk_size)}',
+            after_params,
+        )
+        if not rows:
+            return False
+
+        names = ', '.join(f'`{column}`' for column in self.columns)
+        upper = rows[-1][0]
+        self.execute(
+            f'''
+            INSERT IGNORE INTO `{self.shadow}` ({names})
+            SELECT {names} FROM `{self.table}`
+            WHERE {key} <= %s {'' if self.last_key is None else f'AND {key} > %s'}
+            ''',
+            (upper, *after_params),
+        )
+        self.last_key = upper
+        self.rows_copied += len(rows)
+        self.save_state()
+        self.connection.commit()
+        self.report_progress()
+        return True
+
+    def estimate_rows(self):
+        rows = self.execute(
+            '''
+            SELECT TABLE_ROWS FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            ''',
+            (self.table, ),
+        )
+        return rows[0][0] if rows and rows[0][0] else None
+
+    def report_progress(self):
+        now = time.monotonic()
+        if self.progress is None:
+            self.progress = {
+                'started': now,
+                'rows': self.rows_copied,
+                'reported': 0.0,
+                'total': self.estimate_rows(),
+            }
+        progress = self.progress
+        if now - progress['reported'] < REPORT_INTERVAL:
+            return
+        progress['reported'] = now
+        rate = (self.rows_copied - progress['rows']) / max(now - progress['started'], 1e-6)
+        text = f'{self.table}: copied {self.rows_copied} rows'
+        total = progress['total']
+        if total:
+            percent = min(100.0, 100.0 * self.rows_copied / total)
+            text += f' of ~{total} ({percent:.0f}%)'
+            if rate > 0 and total > self.rows_copied:
+                text += f', ~{(total - self.rows_copied) / rate:.0f}s left'
+        self.report(f'{text}, {rate:.0f} rows/s')
+
+    #throttling
+
+    def throttle(self):
+        while True:
+            reason = self.throttle_reason()
+            if reason is None:
+                break
+            self.report(f'{self.table}: throttled, {reason}')
+            time.sleep(THROTTLE_WAIT)
+        if self.pause:
+            time.sleep(self.pause)
+
+    def throttle_reason(self):
+        if self.max_threads_running:
+            rows = self.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+            threads_running = int(rows[0][1])
+            if threads_running > self.max_threads_running:
+                return f'{threads_running} threads running'
+        if self.max_lag is not None:
+            for replica in self.replicas:
+                lag = get_replication_lag(replica)
+                if lag is None or lag > self.max_lag:
+                    return f'replica {replica.server_host} lagging ({lag}s)'
+        return None
+
+    #cut-over
+
+    def cut_over(self):
+        # Triggers move with the table they are on, so they stay on the old
+        # table: no write is missed between the rename and dropping them.
+        self.execute('SET SESSION lock_wait_timeout = %s', (CUT_OVER_LOCK_WAIT, ))
+        for _ in range(CUT_OVER_ATTEMPTS):
+            try:
+                self.execute(f'RENAME TABLE `{self.table}` TO `{self.old}`, `{self.shadow}` TO `{self.table}`')
+                break
+            except DatabaseError as exception:
+                if exception.errno != ER_LOCK_WAIT_TIMEOUT:
+                    raise
+                self.report(f'{self.table}: rename waiting for running transactions, retrying')
+        else:
+            raise RuntimeError(f'{self.table}: could not rename; run again to retry the cut-over')
+        self.finish()
+
+    def finish(self):
+        self.drop_triggers()
+        self.execute(f'DELETE FROM {STATE_TABLE} WHERE table_name = %s', (self.table, ))
+        self.connection.commit()
+        if not self.keep_old:
+            self.execute(f'DROP TABLE `{self.old}`')
+        self.report(f'{self.table}: migrated, {self.rows_copied} rows copied')
+
+    def abort(self):
+        self.drop_triggers()
+        self.execute(f'DROP TABLE IF EXISTS `{self.shadow}`')
+        self.read_state()
+        self.execute(f'DELETE FROM {STATE_TABLE} WHERE table_name = %s', (self.table, ))
+        self.connection.commit()
+        self.report(f'{self.table}: online migration aborted')
+
+    def table_exists(self, table):
+        return bool(self.execute(
+            '''
+            SELECT 1 FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            ''',
+            (table, ),
+        ))
+
+
+def discard_all(connection):
+    # Drops whatever online migrations left in the database: triggers and
+    # shadow tables of unfinished ones, old tables kept with keep_old and
+    # the saved progress. For rebuilding the schema from scratch, since
+    # shadow and old tables keep foreign keys to the tables it drops.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            '''
+            SELECT TRIGGER_NAME FROM information_schema.TRIGGERS
+            WHERE TRIGGER_SCHEMA = DATABASE() AND TRIGGER_NAME LIKE %s
+            ''',
+            ('\\_%\\_online\\_%', ),
+        )
+        triggers = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            '''
+            SELECT TABLE_NAME FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND (TABLE_NAME LIKE %s OR TABLE_NAME LIKE %s)
+            ''',
+            ('\\_%\\_new', '\\_%\\_old'),
+        )
+        tables = [row[0] for row in cursor.fetchall()]
+        for trigger in triggers:
+            cursor.execute(f'DROP TRIGGER IF EXISTS `{trigger}`')
+        if tables:
+            cursor.execute(f'DROP TABLE IF EXISTS {", ".join(f"`{table}`" for table in tables)}')
+        cursor.execute(f'DROP TABLE IF EXISTS {STATE_TABLE}')
+    connection.commit()
+
+
+def get_replication_lag(replica):
+    with replica.cursor(dictionary=True) as cursor:
+        cursor.execute('SHOW REPLICA STATUS')
+        rows = cursor.fetchall()
+    if not rows:
+        return 0
+    return rows[0].get('Seconds_Behind_Source')
@@ -5,6 +5,8 @@ import os.path
 
 import mysql.connector as cnt
 
+from .online_migration import OnlineMigration, discard_all
+
 
 def get_config_filename():
     return os.path.join(
@@ -24,6 +26,15 @@ def get_config_test_filename():
     )
 
 
+def get_config_test_shards_filename():
+    return os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        'config',
+        'config_test_shards.json',
+    )
+
+
 def get_app_secrets_filename():
     return os.path.join(
         os.path.dirname(__file__),
@@ -49,31 +60,115 @@ def run_script(filename_script, filename_config, filename_secrets):
         config = json.load(file)
     with open(filename_secrets, 'r') as file:
         secrets = json.load(file)
-    conn = cnt.connect(
-        host=config['db_host'],
-        database=config['database'],
-        user=secrets['user'],
-        password=secrets['password'],
+    # With sharding, every shard gets the same schema as the main database.
+    for database in get_databases(config):
+        conn = cnt.connect(
+            **database,
+            user=secrets['user'],
+            password=secrets['password'],
+        )
+        with conn.cursor() as cursor:
+            # One has to iterate through the results to get them executed properly
+            # when using multi=True in this library. Makes sense after reflecting
+            # on it: each cursor has to be exhausted before emitting another
+            # command. Docs are not that clear, though:
+            # https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-execute.html
+            for _ in cursor.execute(script, multi=True):
+                pass
+        conn.commit()
+        conn.close()
+
+
+def run_online_migration(
+        table,
+        alter,
+        filename_config,
+        filename_secrets,
+        replica_hosts=(),
+        abort=False,
+        **options,
+):
+    # Runs ALTER TABLE `table` `alter` without locking the table for the
+    # length of a rebuild, see online_migration.py. `options` are passed to
+    # OnlineMigration.
+    with open(filename_config, 'r') as file:
+        config = json.load(file)
+    with open(filename_secrets, 'r') as file:
+        secrets = json.load(file)
+    for database in get_databases(config):
+        conn = cnt.connect(
+            **database,
+            user=secrets['user'],
+            password=secrets['password'],
+        )
+        replicas = [
+            cnt.connect(
+                host=host,
+                user=secrets['user'],
+                password=secrets['password'],
+            )
+            for host in replica_hosts
+        ]
+        try:
+            migration = OnlineMigration(conn, table, alter, replicas=replicas, **options)
+            if abort:
+                migration.abort()
+            else:
+                migration.run()
+        finally:
+            for connection in [conn, *replicas]:
+                connection.close()
+
+
+def run_online_script(filename_script, filename_config, filename_secrets):
+    # Online migrations are JSON files holding the run_online_migration
+    # arguments, e.g. {"table": "tasks", "alter": "ADD ...", "chunk_size": 500}.
+    with open(filename_script, 'r') as file:
+        migration = json.load(file)
+    run_online_migration(
+        migration.pop('table'),
+        migration.pop('alter'),
+        filename_config,
+        filename_secrets,
+        **migration,
     )
-    with conn.cursor() as cursor:
-        # One has to iterate through the results to get them executed properly
-        # when using multi=True in this library. Makes sense after reflecting
-        # on it: each cursor has to be exhausted before emitting another
-        # command. Docs are not that clear, though:
-        # https://dev.mysql.com/doc/connector-python/en/connector-python-api-mysqlcursor-execute.html
-        for _ in cursor.execute(script, multi=True):
-            pass
-    conn.commit()
-    conn.close()
+
+
+def discard_online_migrations(filename_config, filename_secrets):
+    with open(filename_config, 'r') as file:
+        config = json.load(file)
+    with open(filename_secrets, 'r') as file:
+        secrets = json.load(file)
+    for database in get_databases(config):
+        conn = cnt.connect(
+            **database,
+            user=secrets['user'],
+            password=secrets['password'],
+        )
+        try:
+            discard_all(conn)
+        finally:
+            conn.close()
+
+
+def get_databases(config):
+    return [
+        {'host': database['db_host'], 'database': database['database']}
+        for database in [config, *config.get('shards', [])]
+    ]
 
 
 def run_all_scripts(scripts_dir, filename_config, filename_secrets):
     filenames = sorted([
         filename for filename in os.listdir(scripts_dir)
-        if filename.endswith('.sql')
+        if filename.endswith('.sql') or filename.endswith('.json')
     ])
+    # The scripts rebuild the schema from scratch: leftovers of online
+    # migrations would hold foreign keys to the tables they drop.
+    discard_online_migrations(filename_config, filename_secrets)
     for filename in filenames:
-        run_script(
+        run = run_online_script if filename.endswith('.json') else run_script
+        run(
             os.path.join(scripts_dir, filename),
             filename_config,
             filename_secrets,